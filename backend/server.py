@@ -1,8 +1,11 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, BackgroundTasks, UploadFile, File
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, WebSocket, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
+from fastapi.responses import StreamingResponse, Response
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 import os
 import logging
 from pathlib import Path
@@ -13,10 +16,29 @@ from datetime import datetime, timezone, timedelta
 import bcrypt
 import jwt
 import docker
-from docker.errors import DockerException
+from docker.errors import DockerException, NotFound
 import httpx
 import asyncio
-import shutil
+import bisect
+import hmac
+import itertools
+import time
+import json
+import hashlib
+import codecs
+import ctypes
+import csv
+import io
+import resource
+import signal
+import socket
+import tarfile
+import tempfile
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -35,6 +57,37 @@ api_router = APIRouter(prefix="/api")
 security = HTTPBearer()
 JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production')
 JWT_ALGORITHM = 'HS256'
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+BCRYPT_WORKERS = int(os.environ.get('BCRYPT_WORKERS', '2'))
+BCRYPT_MAX_PENDING = int(os.environ.get('BCRYPT_MAX_PENDING', '64'))
+LOGIN_THROTTLE_WINDOW = float(os.environ.get('LOGIN_THROTTLE_WINDOW', '300'))
+LOGIN_MAX_FAILURES_PER_EMAIL = int(os.environ.get('LOGIN_MAX_FAILURES_PER_EMAIL', '5'))
+LOGIN_MAX_FAILURES_PER_IP = int(os.environ.get('LOGIN_MAX_FAILURES_PER_IP', '30'))
+TRUST_PROXY_HEADERS = os.environ.get('TRUST_PROXY_HEADERS', 'false').lower() in ('1', 'true', 'yes')
+# Proxies in front of the API that append to X-Forwarded-For; the client address is
+# the entry this many hops from the right, since everything left of it is client-supplied
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', '1'))
+FLAG_DIGEST_SALT = os.environ.get('FLAG_DIGEST_SALT', '').encode('utf-8') or os.urandom(32)
+SUBMISSION_BUFFER_FLUSH_MS = int(os.environ.get('SUBMISSION_BUFFER_FLUSH_MS', '250'))
+SUBMISSION_BUFFER_BATCH_SIZE = int(os.environ.get('SUBMISSION_BUFFER_BATCH_SIZE', '500'))
+SUBMISSION_BUFFER_MAX_SIZE = int(os.environ.get('SUBMISSION_BUFFER_MAX_SIZE', '20000'))
+SUBMISSION_BUFFER_OVERFLOW = os.environ.get('SUBMISSION_BUFFER_OVERFLOW', 'write_through')  # write_through, drop_oldest or drop_newest
+ROOM_ANSWER_CACHE_TTL = float(os.environ.get('ROOM_ANSWER_CACHE_TTL', '60'))
+CATALOG_CACHE_TTL = float(os.environ.get('CATALOG_CACHE_TTL', '60'))
+LEADERBOARD_WINDOW_RETENTION_DAYS = int(os.environ.get('LEADERBOARD_WINDOW_RETENTION_DAYS', '365'))
+LEADERBOARD_REBUILD_INTERVAL = float(os.environ.get('LEADERBOARD_REBUILD_INTERVAL', '300'))
+PLATFORM_STATS_RECONCILE_INTERVAL = float(os.environ.get('PLATFORM_STATS_RECONCILE_INTERVAL', '300'))
+INDEX_CHECK_MODE = os.environ.get('INDEX_CHECK_MODE', 'off')  # off, warn or strict
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')  # memory or mongo
+# Per-route list of [scope, max attempts, window seconds]; RATE_LIMIT_POLICIES (JSON) overrides routes
+RATE_LIMIT_POLICIES = {
+    'flags_submit': [['user', 30, 60], ['room', 10, 60]],
+    'room_flags_check': [['user', 60, 60], ['flag', 10, 60]],
+    'room_flags_check_batch': [['user', 20, 60], ['room', 5, 60]],
+    **json.loads(os.environ.get('RATE_LIMIT_POLICIES', '{}'))
+}
+PRINCIPAL_CACHE_TTL = float(os.environ.get('PRINCIPAL_CACHE_TTL', '30'))
+PRINCIPAL_CACHE_MAX_ENTRIES = int(os.environ.get('PRINCIPAL_CACHE_MAX_ENTRIES', '50000'))
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -47,6 +100,236 @@ except DockerException as e:
     logger.warning(f"Docker not available: {e}. Container features will be disabled.")
     docker_client = None
 
+LAB_DOCKER_WORKERS = int(os.environ.get('LAB_DOCKER_WORKERS', '16'))
+LAB_MAX_CONCURRENT = int(os.environ.get('LAB_MAX_CONCURRENT', '8'))
+LAB_QUEUE_MAX = int(os.environ.get('LAB_QUEUE_MAX', '500'))
+LAB_SESSION_TTL = int(os.environ.get('LAB_SESSION_TTL', '3600'))
+LAB_REAPER_INTERVAL = float(os.environ.get('LAB_REAPER_INTERVAL', '30'))
+LAB_REAPER_BATCH_SIZE = int(os.environ.get('LAB_REAPER_BATCH_SIZE', '20'))
+LAB_EXEC_MAX_BYTES = int(os.environ.get('LAB_EXEC_MAX_BYTES', str(1024 * 1024)))
+LAB_EXEC_TIMEOUT = float(os.environ.get('LAB_EXEC_TIMEOUT', '30'))
+LAB_EXEC_CHUNK_SIZE = int(os.environ.get('LAB_EXEC_CHUNK_SIZE', str(16 * 1024)))
+LAB_TERMINAL_SCROLLBACK = int(os.environ.get('LAB_TERMINAL_SCROLLBACK', str(64 * 1024)))
+LAB_POOL_MIN_SIZE = int(os.environ.get('LAB_POOL_MIN_SIZE', '2'))
+LAB_POOL_MAX_SIZE = int(os.environ.get('LAB_POOL_MAX_SIZE', '10'))
+LAB_POOL_REFILL_INTERVAL = float(os.environ.get('LAB_POOL_REFILL_INTERVAL', '10'))
+LAB_RECONCILE_GRACE = float(os.environ.get('LAB_RECONCILE_GRACE', '300'))
+LAB_RECONCILE_INTERVAL = float(os.environ.get('LAB_RECONCILE_INTERVAL', '600'))
+
+# Every container this app creates carries LAB_LABEL plus the id of the worker that
+# created it; reconcile only ever looks at containers with that label
+LAB_LABEL = 'hacklido.lab'
+LAB_INSTANCE_LABEL = 'hacklido.instance'
+LAB_INSTANCE_ID = uuid.uuid4().hex
+
+LAB_UPLOAD_MAX_BYTES = int(os.environ.get('LAB_UPLOAD_MAX_BYTES', str(100 * 1024 * 1024)))
+LAB_FILES_DIR = os.environ.get('LAB_FILES_DIR', '/root/lab')  # where room files land in lab containers
+LAB_ARCHIVE_GRACE = float(os.environ.get('LAB_ARCHIVE_GRACE', '3600'))
+LAB_UPLOAD_CHUNK_SIZE = int(os.environ.get('LAB_UPLOAD_CHUNK_SIZE', str(1024 * 1024)))
+
+LAB_CONTAINER_OPTIONS = {
+    'detach': True,
+    'stdin_open': True,
+    'tty': True,
+    'mem_limit': '512m',
+    'nano_cpus': 1_000_000_000,
+    'remove': False
+}
+
+class LabOrchestrator:
+    # Runs blocking Docker SDK calls on a bounded thread pool so they never block the
+    # event loop. Lab operations are admitted through a FIFO queue with a global
+    # concurrency limit; the executor is sized above that limit so background work
+    # (pool refills) still makes progress while every slot is taken.
+    def __init__(self, workers: int, max_concurrent: int, max_queue: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='lab-docker')
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.active = 0
+        self.waiters: deque = deque()
+
+    def queue_position(self, user_id: str) -> Optional[int]:
+        for position, (waiter_id, _) in enumerate(self.waiters, start=1):
+            if waiter_id == user_id:
+                return position
+        return None
+
+    def status(self) -> Dict[str, int]:
+        return {
+            'active': self.active,
+            'waiting': len(self.waiters),
+            'max_concurrent': self.max_concurrent,
+            'max_queue': self.max_queue
+        }
+
+    async def acquire(self, user_id: str) -> int:
+        if self.active < self.max_concurrent and not self.waiters:
+            self.active += 1
+            return 0
+        if len(self.waiters) >= self.max_queue:
+            raise HTTPException(status_code=503, detail="Lab queue is full, try again shortly")
+        waiter = (user_id, asyncio.get_running_loop().create_future())
+        self.waiters.append(waiter)
+        position = len(self.waiters)
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            else:
+                self.release()
+            raise
+        return position
+
+    def release(self):
+        # Hand the slot straight to the next waiter so admission stays FIFO
+        while self.waiters:
+            _, future = self.waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, user_id: str):
+        position = await self.acquire(user_id)
+        try:
+            yield position
+        finally:
+            self.release()
+
+    async def run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(fn, *args, **kwargs))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+lab_orchestrator = LabOrchestrator(LAB_DOCKER_WORKERS, LAB_MAX_CONCURRENT, LAB_QUEUE_MAX)
+
+def stop_and_remove_container(container_id: str):
+    container = docker_client.containers.get(container_id)
+    container.stop()
+    container.remove()
+
+def put_lab_archive(container, archive_path: Path):
+    # Streams the tar from disk; entries carry their full path, so extract at /
+    with open(archive_path, 'rb') as data:
+        container.put_archive('/', data)
+
+def start_lab_exec(container_id: str, cmd: str):
+    # coreutils timeout kills the command in the container once the time cap passes,
+    # even after we have stopped reading its output
+    exec_id = docker_client.api.exec_create(
+        container_id,
+        ['timeout', '-s', 'KILL', str(int(LAB_EXEC_TIMEOUT) + 1), '/bin/bash', '-c', cmd],
+        stdout=True,
+        stderr=True
+    )['Id']
+    sock = docker_client.api.exec_start(exec_id, socket=True)
+    return exec_id, sock
+
+class WarmContainerPool:
+    # Idle containers per docker_image, claimed by start_lab and refilled in the background.
+    # The per-image target starts at min_size, grows on every cold-start miss up to
+    # max_size and decays back towards min_size while the pool keeps up with demand.
+    def __init__(self, min_size: int, max_size: int, refill_interval: float):
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size)
+        self.refill_interval = refill_interval
+        self.idle: Dict[str, deque] = {}
+        self.targets: Dict[str, int] = {}
+        self.misses: Dict[str, int] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def register_image(self, image: str):
+        if image not in self.idle:
+            self.idle[image] = deque()
+            self.targets[image] = self.min_size
+            self.misses[image] = 0
+            self._wakeup.set()
+
+    async def claim(self, image: str, name: str):
+        self.register_image(image)
+        pool = self.idle[image]
+        while pool:
+            container = pool.popleft()
+            self._wakeup.set()
+            try:
+                await lab_orchestrator.run(container.rename, name)
+                return container
+            except Exception as e:
+                logger.warning(f"Discarding warm container {container.id}: {e}")
+                asyncio.create_task(lab_orchestrator.run(self._discard, container))
+        self.misses[image] += 1
+        self.targets[image] = min(self.targets[image] + 1, self.max_size)
+        self._wakeup.set()
+        return None
+
+    def _create(self, image: str):
+        return docker_client.containers.run(
+            image,
+            labels={LAB_LABEL: '1', LAB_INSTANCE_LABEL: LAB_INSTANCE_ID, 'lab_pool': 'warm', 'docker_image': image},
+            **LAB_CONTAINER_OPTIONS
+        )
+
+    def _discard(self, container):
+        try:
+            container.remove(force=True)
+        except Exception as e:
+            logger.error(f"Error removing warm container {container.id}: {e}")
+
+    async def _refill(self, image: str):
+        pool = self.idle[image]
+        if self.misses[image] == 0 and self.targets[image] > self.min_size:
+            self.targets[image] -= 1
+        self.misses[image] = 0
+
+        while len(pool) > self.targets[image]:
+            await lab_orchestrator.run(self._discard, pool.pop())
+
+        deficit = self.targets[image] - len(pool)
+        if deficit <= 0:
+            return
+        results = await asyncio.gather(
+            *[lab_orchestrator.run(self._create, image) for _ in range(deficit)],
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"Error warming container for {image}: {result}")
+            else:
+                pool.append(result)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.refill_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            for image in list(self.idle):
+                try:
+                    await self._refill(image)
+                except Exception as e:
+                    logger.error(f"Error refilling lab pool for {image}: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def drain(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        containers = [c for pool in self.idle.values() for c in pool]
+        for pool in self.idle.values():
+            pool.clear()
+        await asyncio.gather(*[lab_orchestrator.run(self._discard, c) for c in containers])
+
+lab_pool = WarmContainerPool(LAB_POOL_MIN_SIZE, LAB_POOL_MAX_SIZE, LAB_POOL_REFILL_INTERVAL)
+
 class User(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -59,6 +342,7 @@ class User(BaseModel):
     streak: int = 0
     badges: List[str] = []
     completed_rooms: List[str] = []
+    completed_challenges: List[str] = []
     achievements: List[str] = []
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
@@ -108,6 +392,7 @@ class LabSession(BaseModel):
     container_id: Optional[str] = None
     status: str = "pending"
     started_at: Optional[datetime] = None
+    expires_at: Optional[datetime] = None
     ended_at: Optional[datetime] = None
 
 class CodingChallenge(BaseModel):
@@ -139,12 +424,13 @@ class SubmitFlagRequest(BaseModel):
     room_id: str
     flag: str
 
-class StartLabRequest(BaseModel):
-    room_id: str
+class GradeSubmissionRequest(BaseModel):
+    code: str
+    stop_on_failure: bool = False
 
-class SubmitFlagRequest(BaseModel):
+class BatchAnswerRequest(BaseModel):
     room_id: str
-    flag: str
+    answers: Dict[str, str]
 
 class RoomFlagModel(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -179,11 +465,157 @@ class QuestionModel(BaseModel):
     replied_at: Optional[datetime] = None
 
 def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode('utf-8')
 
 def verify_password(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
+password_executor = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix='bcrypt')
+password_slots = asyncio.Semaphore(BCRYPT_MAX_PENDING)
+
+async def run_password_work(fn, *args):
+    # bcrypt is deliberately slow; keep it off the event loop and shed load once
+    # BCRYPT_MAX_PENDING hashes are already queued or running
+    if password_slots.locked():
+        raise HTTPException(status_code=503, detail="Server busy, try again shortly", headers={'Retry-After': '1'})
+    async with password_slots:
+        return await asyncio.get_running_loop().run_in_executor(password_executor, fn, *args)
+
+class LoginThrottle:
+    # Sliding-window count of failed logins per email and per client IP. Checked
+    # before any user lookup or hash, so credential stuffing costs no bcrypt work.
+    def __init__(self, window: float, max_per_email: int, max_per_ip: int, max_keys: int = 100000):
+        self.window = window
+        self.limits = {'email': max_per_email, 'ip': max_per_ip}
+        self.max_keys = max_keys
+        self.failures: OrderedDict = OrderedDict()
+
+    def _recent(self, key: str) -> Optional[deque]:
+        attempts = self.failures.get(key)
+        if attempts is None:
+            return None
+        cutoff = time.monotonic() - self.window
+        while attempts and attempts[0] < cutoff:
+            attempts.popleft()
+        if not attempts:
+            del self.failures[key]
+            return None
+        return attempts
+
+    def check(self, email: str, ip: str):
+        for kind, value in (('email', email.lower()), ('ip', ip)):
+            attempts = self._recent(f"{kind}:{value}")
+            if attempts and len(attempts) >= self.limits[kind]:
+                retry_after = int(attempts[0] + self.window - time.monotonic()) + 1
+                raise HTTPException(
+                    status_code=429,
+                    detail="Too many failed login attempts, try again later",
+                    headers={'Retry-After': str(max(retry_after, 1))}
+                )
+
+    def record_failure(self, email: str, ip: str):
+        now = time.monotonic()
+        for kind, value in (('email', email.lower()), ('ip', ip)):
+            key = f"{kind}:{value}"
+            attempts = self.failures.setdefault(key, deque(maxlen=self.limits[kind]))
+            attempts.append(now)
+            self.failures.move_to_end(key)
+        while len(self.failures) > self.max_keys:
+            self.failures.popitem(last=False)
+
+    def reset(self, email: str):
+        self.failures.pop(f"email:{email.lower()}", None)
+
+login_throttle = LoginThrottle(LOGIN_THROTTLE_WINDOW, LOGIN_MAX_FAILURES_PER_EMAIL, LOGIN_MAX_FAILURES_PER_IP)
+
+class MemoryRateLimitBackend:
+    # Token bucket per key: `limit` tokens, refilled continuously over `window` seconds
+    def __init__(self, max_keys: int = 200000):
+        self.buckets: OrderedDict = OrderedDict()
+        self.max_keys = max_keys
+
+    async def hit(self, key: str, limit: int, window: float) -> float:
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(key, (float(limit), now))
+        tokens = min(float(limit), tokens + (now - updated) * limit / window)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now)
+            return (1 - tokens) * window / limit
+        self.buckets[key] = (tokens - 1, now)
+        self.buckets.move_to_end(key)
+        while len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+        return 0.0
+
+class MongoRateLimitBackend:
+    # Sliding-window counter shared by every worker: one counter document per key and
+    # fixed window in rate_limits (expired by TTL), with the previous window's count
+    # weighted by how much of it still overlaps the sliding window
+    async def hit(self, key: str, limit: int, window: float) -> float:
+        now = time.time()
+        current = int(now // window)
+        elapsed = (now % window) / window
+        counter, previous = await asyncio.gather(
+            db.rate_limits.find_one_and_update(
+                {'_id': f"{key}:{current}"},
+                {'$inc': {'count': 1}, '$setOnInsert': {
+                    'expires_at': datetime.fromtimestamp((current + 2) * window, timezone.utc)
+                }},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            ),
+            db.rate_limits.find_one({'_id': f"{key}:{current - 1}"})
+        )
+        estimate = counter['count'] + (previous['count'] if previous else 0) * (1 - elapsed)
+        if estimate <= limit:
+            return 0.0
+        return (1 - elapsed) * window
+
+class RateLimiter:
+    # Applies the per-route policies in RATE_LIMIT_POLICIES. Each scope names the value
+    # a limit is keyed on (the caller plus the room or flag being guessed), so one script
+    # cannot spray guesses at a single room or across the whole platform.
+    def __init__(self, backend, policies: Dict[str, List[List[Any]]]):
+        self.backend = backend
+        self.policies = policies
+        self.allowed: Dict[str, int] = {}
+        self.rejected: Dict[str, int] = {}
+
+    async def check(self, route: str, user_id: str, **scopes: str):
+        for scope, limit, window in self.policies.get(route, []):
+            value = user_id if scope == 'user' else f"{user_id}:{scopes[scope]}"
+            try:
+                retry_after = await self.backend.hit(f"{route}:{scope}:{value}", limit, window)
+            except Exception as e:
+                # A broken shared backend must not lock everyone out
+                logger.error(f"Rate limiter backend error: {e}")
+                retry_after = 0.0
+            if retry_after > 0:
+                counter = f"{route}:{scope}"
+                self.rejected[counter] = self.rejected.get(counter, 0) + 1
+                raise HTTPException(
+                    status_code=429,
+                    detail="Too many attempts, slow down",
+                    headers={'Retry-After': str(int(retry_after) + 1)}
+                )
+        self.allowed[route] = self.allowed.get(route, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {'backend': RATE_LIMIT_BACKEND, 'allowed': dict(self.allowed), 'rejected': dict(self.rejected)}
+
+rate_limiter = RateLimiter(
+    MongoRateLimitBackend() if RATE_LIMIT_BACKEND == 'mongo' else MemoryRateLimitBackend(),
+    RATE_LIMIT_POLICIES
+)
+
+def client_ip(request: Request) -> str:
+    if TRUST_PROXY_HEADERS:
+        forwarded = request.headers.get('x-forwarded-for')
+        if forwarded:
+            hops = [hop.strip() for hop in forwarded.split(',')]
+            return hops[-min(max(TRUSTED_PROXY_HOPS, 1), len(hops))]
+    return request.client.host if request.client else 'unknown'
+
 def create_token(user_id: str, email: str, role: str) -> str:
     payload = {
         'user_id': user_id,
@@ -193,19 +625,55 @@ def create_token(user_id: str, email: str, role: str) -> str:
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+class PrincipalCache:
+    # Short-lived cache of resolved users so authenticated requests normally skip
+    # the users lookup. Code paths that change a user call invalidate(); the TTL
+    # bounds staleness for changes made by other workers.
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries: OrderedDict = OrderedDict()
+
+    def get(self, user_id: str) -> Optional[Dict[str, Any]]:
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return None
+        expires_at, user = entry
+        if expires_at < time.monotonic():
+            del self.entries[user_id]
+            return None
+        return dict(user)
+
+    def put(self, user: Dict[str, Any]):
+        self.entries[user['id']] = (time.monotonic() + self.ttl, user)
+        self.entries.move_to_end(user['id'])
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, user_id: str):
+        self.entries.pop(user_id, None)
+
+principal_cache = PrincipalCache(PRINCIPAL_CACHE_TTL, PRINCIPAL_CACHE_MAX_ENTRIES)
+
+async def get_user_from_token(token: str):
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        user = await db.users.find_one({'id': payload['user_id']}, {'_id': 0, 'hashed_password': 0})
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
+        user = principal_cache.get(payload['user_id'])
+        if user is None:
+            user = await db.users.find_one({'id': payload['user_id']}, {'_id': 0, 'hashed_password': 0})
+            if not user:
+                raise HTTPException(status_code=401, detail="User not found")
+            principal_cache.put(user)
+            user = dict(user)
         return user
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except Exception:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return await get_user_from_token(credentials.credentials)
+
 @api_router.post("/auth/register")
 async def register(user_data: UserRegister):
     existing = await db.users.find_one({'email': user_data.email}, {'_id': 0})
@@ -215,12 +683,18 @@ async def register(user_data: UserRegister):
     user = User(
         email=user_data.email,
         username=user_data.username,
-        hashed_password=hash_password(user_data.password)
+        hashed_password=await run_password_work(hash_password, user_data.password)
     )
     
     user_dict = user.model_dump()
     user_dict['created_at'] = user_dict['created_at'].isoformat()
-    await db.users.insert_one(user_dict)
+    try:
+        await db.users.insert_one(user_dict)
+    except DuplicateKeyError:
+        # A concurrent registration with the same email won the unique index
+        raise HTTPException(status_code=400, detail="Email already registered")
+    platform_stats.adjust('total_users', 1)
+    leaderboard.update(user_dict)
     
     token = create_token(user.id, user.email, user.role)
     return {
@@ -236,10 +710,15 @@ async def register(user_data: UserRegister):
     }
 
 @api_router.post("/auth/login")
-async def login(login_data: UserLogin):
+async def login(login_data: UserLogin, request: Request):
+    ip = client_ip(request)
+    login_throttle.check(login_data.email, ip)
+    
     user = await db.users.find_one({'email': login_data.email}, {'_id': 0})
-    if not user or not verify_password(login_data.password, user['hashed_password']):
+    if not user or not await run_password_work(verify_password, login_data.password, user['hashed_password']):
+        login_throttle.record_failure(login_data.email, ip)
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    login_throttle.reset(login_data.email)
     
     token = create_token(user['id'], user['email'], user['role'])
     return {
@@ -260,41 +739,170 @@ async def login(login_data: UserLogin):
 async def get_me(current_user: dict = Depends(get_current_user)):
     return current_user
 
+class CatalogCache:
+    # In-process snapshot of roadmaps and rooms. Admin writes call invalidate(), which
+    # bumps the version so the next read reloads; CATALOG_CACHE_TTL bounds staleness for
+    # writes made by other workers or the seed scripts. Serialized bodies and their
+    # content-derived ETags are memoized per snapshot, so repeat reads cost neither a
+    # database round-trip nor re-serialization, and conditional requests get a 304.
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.version = 0
+        self.loaded_version = -1
+        self.loaded_at = 0.0
+        self.roadmaps: List[Dict[str, Any]] = []
+        self.rooms: List[Dict[str, Any]] = []
+        self.room_keys: List[str] = []
+        self.rooms_by_id: Dict[str, Dict[str, Any]] = {}
+        self.bodies: Dict[tuple, tuple] = {}
+        self.reload_hooks: List = []
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self.version += 1
+
+    def fresh(self) -> bool:
+        return self.loaded_version == self.version and time.monotonic() - self.loaded_at < self.ttl
+
+    async def ensure(self):
+        if self.fresh():
+            return
+        async with self._lock:
+            if self.fresh():
+                return
+            version = self.version
+            roadmaps = await db.roadmaps.find({}, {'_id': 0}).sort('order', 1).to_list(None)
+            # Rooms keep insertion (_id) order; the ObjectId strings double as keyset cursors
+            rooms = await db.rooms.find({}).sort('_id', 1).to_list(None)
+            self.roadmaps = roadmaps
+            self.room_keys = [str(room.pop('_id')) for room in rooms]
+            self.rooms = rooms
+            self.rooms_by_id = {room['id']: room for room in rooms}
+            self.bodies = {}
+            for hook in self.reload_hooks:
+                hook(rooms)
+            self.loaded_version = version
+            self.loaded_at = time.monotonic()
+
+    async def room(self, room_id: str) -> Optional[Dict[str, Any]]:
+        await self.ensure()
+        return self.rooms_by_id.get(room_id)
+
+    def render(self, key: tuple, build) -> tuple:
+        if key not in self.bodies:
+            if len(self.bodies) >= 1000:
+                self.bodies.clear()
+            body = json.dumps(build(), default=str).encode('utf-8')
+            self.bodies[key] = (f'"{hashlib.sha256(body).hexdigest()[:32]}"', body)
+        return self.bodies[key]
+
+catalog = CatalogCache(CATALOG_CACHE_TTL)
+
+class FlagVerifier:
+    # Per-room sets of salted flag digests, rebuilt whenever the catalog reloads. A
+    # submission costs one HMAC and one set lookup. The lookup's timing can only leak
+    # digest bytes, and without the secret salt a caller cannot steer which digest a
+    # guess produces, so no constant-time compare is needed.
+    def __init__(self, salt: bytes):
+        self.salt = salt
+        self.digests: Dict[str, frozenset] = {}
+
+    def digest(self, flag: str) -> bytes:
+        return hmac.new(self.salt, flag.encode('utf-8'), hashlib.sha256).digest()
+
+    def rebuild(self, rooms: List[Dict[str, Any]]):
+        self.digests = {
+            room['id']: frozenset(map(self.digest, room.get('flags', [])))
+            for room in rooms
+        }
+
+    def verify(self, room_id: str, flag: str) -> bool:
+        return self.digest(flag) in self.digests.get(room_id, frozenset())
+
+flag_verifier = FlagVerifier(FLAG_DIGEST_SALT)
+catalog.reload_hooks.append(flag_verifier.rebuild)
+
+def catalog_response(request: Request, etag: str, body: bytes) -> Response:
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if etag in [tag.strip() for tag in request.headers.get('if-none-match', '').split(',')]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type='application/json', headers=headers)
+
 @api_router.get("/roadmaps")
-async def get_roadmaps():
-    roadmaps = await db.roadmaps.find({}, {'_id': 0}).sort('order', 1).to_list(100)
-    return roadmaps
+async def get_roadmaps(request: Request):
+    await catalog.ensure()
+    etag, body = catalog.render(('roadmaps',), lambda: catalog.roadmaps[:100])
+    return catalog_response(request, etag, body)
 
 @api_router.post("/roadmaps")
 async def create_roadmap(roadmap: RoadmapModel, current_user: dict = Depends(get_current_user)):
     if current_user['role'] != 'admin':
         raise HTTPException(status_code=403, detail="Admin only")
     await db.roadmaps.insert_one(roadmap.model_dump())
+    catalog.invalidate()
     return roadmap
 
+# Fields returned by room listings; content, tasks and uploads only come from
+# /rooms/{room_id}, and flags are never sent to clients
+ROOM_SUMMARY_FIELDS = (
+    'id', 'title', 'description', 'difficulty', 'category', 'room_type', 'xp_reward',
+    'has_lab', 'lab_type', 'web_app_url', 'code_language', 'roadmap_id'
+)
+ROOM_PRIVATE_FIELDS = ('flags',)
+
+def room_summary(room: Dict[str, Any]) -> Dict[str, Any]:
+    return {field: room.get(field) for field in ROOM_SUMMARY_FIELDS if field in room}
+
+def room_public(room: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in room.items() if k not in ROOM_PRIVATE_FIELDS}
+
 @api_router.get("/rooms")
-async def get_rooms(roadmap_id: Optional[str] = None, category: Optional[str] = None):
-    query = {}
-    if roadmap_id:
-        query['roadmap_id'] = roadmap_id
-    if category:
-        query['category'] = category
-    rooms = await db.rooms.find(query, {'_id': 0}).to_list(100)
-    return rooms
+async def get_rooms(
+    request: Request,
+    roadmap_id: Optional[str] = None,
+    category: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = 100
+):
+    # Keyset pagination: the X-Next-Cursor response header, when present, is the
+    # cursor for the following page
+    await catalog.ensure()
+    limit = min(max(limit, 1), 100)
+    start = bisect.bisect_right(catalog.room_keys, cursor) if cursor else 0
+    
+    matches = (
+        (key, room) for key, room in zip(catalog.room_keys[start:], catalog.rooms[start:])
+        if (not roadmap_id or room.get('roadmap_id') == roadmap_id)
+        and (not category or room.get('category') == category)
+    )
+    window = list(itertools.islice(matches, limit + 1))
+    page = [room_summary(room) for _, room in window[:limit]]
+    next_cursor = window[limit - 1][0] if len(window) > limit else None
+    
+    etag, body = catalog.render(('rooms', roadmap_id, category, cursor, limit), lambda: page)
+    response = catalog_response(request, etag, body)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
 
 @api_router.get("/rooms/{room_id}")
-async def get_room(room_id: str):
-    room = await db.rooms.find_one({'id': room_id}, {'_id': 0})
+async def get_room(room_id: str, request: Request):
+    room = await catalog.room(room_id)
     if not room:
         raise HTTPException(status_code=404, detail="Room not found")
-    return room
+    etag, body = catalog.render(('room', room_id), lambda: room_public(room))
+    return catalog_response(request, etag, body)
 
 @api_router.post("/rooms")
 async def create_room(room: RoomModel, current_user: dict = Depends(get_current_user)):
     if current_user['role'] != 'admin':
         raise HTTPException(status_code=403, detail="Admin only")
     await db.rooms.insert_one(room.model_dump())
-    return room
+    platform_stats.adjust('total_rooms', 1)
+    catalog.invalidate()
+    if room.has_lab and docker_client:
+        lab_pool.register_image(room.docker_image)
+    return room_public(room.model_dump())
 
 @api_router.put("/rooms/{room_id}")
 async def update_room(room_id: str, room: RoomModel, current_user: dict = Depends(get_current_user)):
@@ -303,19 +911,25 @@ async def update_room(room_id: str, room: RoomModel, current_user: dict = Depend
     result = await db.rooms.update_one({'id': room_id}, {'$set': room.model_dump()})
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Room not found")
-    return room
+    catalog.invalidate()
+    if room.has_lab and docker_client:
+        lab_pool.register_image(room.docker_image)
+    return room_public(room.model_dump())
 
 @api_router.delete("/rooms/{room_id}")
 async def delete_room(room_id: str, current_user: dict = Depends(get_current_user)):
     if current_user['role'] != 'admin':
         raise HTTPException(status_code=403, detail="Admin only")
-    result = await db.rooms.delete_one({'id': room_id})
-    if result.deleted_count == 0:
+    room = await db.rooms.find_one_and_delete({'id': room_id}, {'_id': 0, 'uploaded_files': 1})
+    if room is None:
         raise HTTPException(status_code=404, detail="Room not found")
+    platform_stats.adjust('total_rooms', -1)
+    catalog.invalidate()
+    await lab_files.collect(f['digest'] for f in room.get('uploaded_files', []) if f.get('digest'))
     return {'message': 'Room deleted'}
 
 @api_router.post("/labs/start")
-async def start_lab(request: StartLabRequest, background_tasks: BackgroundTasks, current_user: dict = Depends(get_current_user)):
+async def start_lab(request: StartLabRequest, current_user: dict = Depends(get_current_user)):
     room = await db.rooms.find_one({'id': request.room_id}, {'_id': 0})
     if not room or not room.get('has_lab'):
         raise HTTPException(status_code=400, detail="Room has no lab")
@@ -335,56 +949,261 @@ async def start_lab(request: StartLabRequest, background_tasks: BackgroundTasks,
         status="starting"
     )
     
+    queue_position = 0
     if docker_client:
-        try:
-            container = docker_client.containers.run(
-                room.get('docker_image', 'ubuntu:20.04'),
-                detach=True,
-                stdin_open=True,
-                tty=True,
-                mem_limit='512m',
-                cpus=1.0,
-                name=f"lab-{session.id}",
-                labels={'user_id': current_user['id'], 'room_id': request.room_id},
-                remove=False
-            )
-            session.container_id = container.id
-            session.status = "running"
-            session.started_at = datetime.now(timezone.utc)
-            background_tasks.add_task(auto_stop_container, container.id, 3600)
-        except Exception as e:
-            logger.error(f"Docker error: {e}")
-            session.status = "error"
+        async with lab_orchestrator.slot(current_user['id']) as queue_position:
+            try:
+                image = room.get('docker_image', 'ubuntu:20.04')
+                container = await lab_pool.claim(image, f"lab-{session.id}")
+                if container is None:
+                    container = await lab_orchestrator.run(
+                        docker_client.containers.run,
+                        image,
+                        name=f"lab-{session.id}",
+                        labels={
+                            LAB_LABEL: '1', LAB_INSTANCE_LABEL: LAB_INSTANCE_ID,
+                            'user_id': current_user['id'], 'room_id': request.room_id
+                        },
+                        **LAB_CONTAINER_OPTIONS
+                    )
+                if room.get('uploaded_files'):
+                    try:
+                        archive = await lab_files.archive(room['uploaded_files'])
+                        await lab_orchestrator.run(put_lab_archive, container, archive)
+                    except Exception:
+                        await lab_orchestrator.run(stop_and_remove_container, container.id)
+                        raise
+                session.container_id = container.id
+                session.status = "running"
+                session.started_at = datetime.now(timezone.utc)
+            except Exception as e:
+                logger.error(f"Docker error: {e}")
+                session.status = "error"
     else:
         session.container_id = f"mock-{uuid.uuid4().hex[:8]}"
         session.status = "running"
         session.started_at = datetime.now(timezone.utc)
     
+    if session.started_at:
+        session.expires_at = session.started_at + timedelta(seconds=LAB_SESSION_TTL)
+    
     session_dict = session.model_dump()
     if session.started_at:
         session_dict['started_at'] = session.started_at.isoformat()
+        session_dict['expires_at'] = session.expires_at.isoformat()
     if session.ended_at:
         session_dict['ended_at'] = session.ended_at.isoformat()
     
     # Insert without _id in response
     await db.lab_sessions.insert_one({**session_dict, '_id': session.id})
+    platform_stats.adjust('total_sessions', 1)
     
     # Return clean dict without _id
-    return {k: v for k, v in session_dict.items() if k != '_id'}
+    return {**{k: v for k, v in session_dict.items() if k != '_id'}, 'queue_position': queue_position}
+
+async def expire_lab_sessions(sessions: List[Dict[str, Any]]):
+    async def remove_container(container_id):
+        try:
+            await lab_orchestrator.run(stop_and_remove_container, container_id)
+        except NotFound:
+            pass
+        except Exception as e:
+            logger.error(f"Error reaping container {container_id}: {e}")
 
-async def auto_stop_container(container_id: str, timeout: int):
-    await asyncio.sleep(timeout)
+    await asyncio.gather(*[close_lab_terminal(s['id']) for s in sessions])
     if docker_client:
+        await asyncio.gather(*[
+            remove_container(s['container_id'])
+            for s in sessions
+            if s.get('container_id') and not s['container_id'].startswith('mock-')
+        ])
+    await db.lab_sessions.update_many(
+        {'id': {'$in': [s['id'] for s in sessions]}, 'status': 'running'},
+        {'$set': {'status': 'expired', 'ended_at': datetime.now(timezone.utc).isoformat()}}
+    )
+
+async def reap_expired_lab_sessions():
+    now = datetime.now(timezone.utc)
+    legacy_cutoff = (now - timedelta(seconds=LAB_SESSION_TTL)).isoformat()
+    while True:
+        # Sessions written before expires_at existed fall back to started_at + TTL
+        expired = await db.lab_sessions.find(
+            {'status': 'running', '$or': [
+                {'expires_at': {'$lte': now.isoformat()}},
+                {'expires_at': None, 'started_at': {'$lte': legacy_cutoff}}
+            ]},
+            {'_id': 0, 'id': 1, 'container_id': 1}
+        ).limit(LAB_REAPER_BATCH_SIZE).to_list(LAB_REAPER_BATCH_SIZE)
+        if not expired:
+            return
+        await expire_lab_sessions(expired)
+        logger.info(f"Reaped {len(expired)} expired lab session(s)")
+
+async def heartbeat_lab_instance():
+    # Marks this worker live so other workers' reconciles leave its warm pool alone
+    await db.lab_instances.update_one(
+        {'_id': LAB_INSTANCE_ID},
+        {'$set': {'seen_at': datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
+async def run_lab_reaper():
+    # Startup reconciles once; later passes collect containers that were still inside
+    # the grace period or owned by a live worker back then (a worker that restarted
+    # quickly, a start_lab that died before writing its session)
+    loop = asyncio.get_running_loop()
+    last_reconcile = loop.time()
+    while True:
         try:
-            container = docker_client.containers.get(container_id)
-            container.stop()
-            container.remove()
-            logger.info(f"Auto-stopped container {container_id}")
+            await heartbeat_lab_instance()
+            await reap_expired_lab_sessions()
         except Exception as e:
-            logger.error(f"Error auto-stopping container: {e}")
+            logger.error(f"Lab reaper error: {e}")
+        if docker_client and loop.time() - last_reconcile >= LAB_RECONCILE_INTERVAL:
+            last_reconcile = loop.time()
+            try:
+                await reconcile_lab_containers()
+            except Exception as e:
+                logger.error(f"Lab reconcile failed: {e}")
+        await asyncio.sleep(LAB_REAPER_INTERVAL)
+
+def list_lab_containers():
+    return docker_client.containers.list(all=True, filters={'label': f"{LAB_LABEL}=1"})
+
+def container_exists(container_id: str) -> bool:
+    try:
+        docker_client.containers.get(container_id)
+        return True
+    except NotFound:
+        return False
+
+def container_age(container) -> float:
+    # Inspect data carries an RFC 3339 timestamp with nanoseconds; list data a Unix time
+    created = container.attrs.get('Created')
+    if isinstance(created, (int, float)):
+        started = datetime.fromtimestamp(created, timezone.utc)
+    else:
+        started = datetime.strptime(created[:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - started).total_seconds()
+
+async def reconcile_lab_containers():
+    containers = await lab_orchestrator.run(list_lab_containers)
+    sessions = await db.lab_sessions.find(
+        {'status': 'running'},
+        {'_id': 0, 'id': 1, 'container_id': 1}
+    ).to_list(None)
+    live_cutoff = datetime.now(timezone.utc) - timedelta(seconds=3 * LAB_REAPER_INTERVAL)
+    live_instances = {
+        i['_id'] for i in await db.lab_instances.find({'seen_at': {'$gte': live_cutoff}}).to_list(None)
+    } | {LAB_INSTANCE_ID}
+    tracked = {s['container_id'] for s in sessions if s.get('container_id')}
+    present = {c.id for c in containers}
+
+    # Untracked containers may belong to a start_lab whose session is not written yet,
+    # or to another live worker's warm pool
+    orphans = [
+        c for c in containers
+        if c.id not in tracked
+        and c.labels.get(LAB_INSTANCE_LABEL) not in live_instances
+        and container_age(c) > LAB_RECONCILE_GRACE
+    ]
+    for i in range(0, len(orphans), LAB_REAPER_BATCH_SIZE):
+        await asyncio.gather(*[
+            lab_orchestrator.run(c.remove, force=True)
+            for c in orphans[i:i + LAB_REAPER_BATCH_SIZE]
+        ], return_exceptions=True)
+
+    # Sessions started before containers were labelled are only lost if Docker no
+    # longer knows their container at all
+    lost = []
+    for session in sessions:
+        container_id = session.get('container_id')
+        if container_id in present:
+            continue
+        if not container_id or not await lab_orchestrator.run(container_exists, container_id):
+            lost.append(session['id'])
+    if lost:
+        await db.lab_sessions.update_many(
+            {'id': {'$in': lost}, 'status': 'running'},
+            {'$set': {'status': 'stopped', 'ended_at': datetime.now(timezone.utc).isoformat()}}
+        )
+    logger.info(f"Lab reconcile: removed {len(orphans)} orphaned container(s), closed {len(lost)} lost session(s)")
+
+@api_router.get("/labs/queue")
+async def get_lab_queue(current_user: dict = Depends(get_current_user)):
+    return {**lab_orchestrator.status(), 'position': lab_orchestrator.queue_position(current_user['id'])}
+
+async def stream_lab_exec(container_id: str, user_id: str, cmd: str):
+    # Yields {'output': text} chunks followed by one {'exit_code', 'truncated'} event.
+    # Docker multiplexes stdout/stderr into 8-byte-header frames; payloads are consumed
+    # as they arrive, so memory stays at one chunk regardless of what the command prints.
+    async with lab_orchestrator.slot(user_id):
+        exec_id, sock = await lab_orchestrator.run(start_lab_exec, container_id, cmd)
+    raw = getattr(sock, '_sock', sock)
+    raw.setblocking(False)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + LAB_EXEC_TIMEOUT
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    header = bytearray()
+    frame_remaining = 0
+    sent = 0
+    truncated = None
+    try:
+        while truncated is None:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                truncated = 'time'
+                break
+            try:
+                data = await asyncio.wait_for(loop.sock_recv(raw, LAB_EXEC_CHUNK_SIZE), remaining)
+            except asyncio.TimeoutError:
+                truncated = 'time'
+                break
+            if not data:
+                break
+            view = memoryview(data)
+            payload = bytearray()
+            while view:
+                if frame_remaining == 0:
+                    needed = 8 - len(header)
+                    header += view[:needed]
+                    view = view[needed:]
+                    if len(header) == 8:
+                        frame_remaining = int.from_bytes(header[4:8], 'big')
+                        header.clear()
+                    continue
+                take = view[:frame_remaining]
+                payload += take
+                frame_remaining -= len(take)
+                view = view[len(take):]
+            if sent + len(payload) > LAB_EXEC_MAX_BYTES:
+                payload = payload[:LAB_EXEC_MAX_BYTES - sent]
+                truncated = 'bytes'
+            sent += len(payload)
+            text = decoder.decode(bytes(payload))
+            if text:
+                yield {'output': text}
+    finally:
+        sock.close()
+    
+    tail = decoder.decode(b'', final=True)
+    if truncated == 'bytes':
+        tail += f"\n[output truncated: exceeded {LAB_EXEC_MAX_BYTES} bytes]\n"
+    elif truncated == 'time':
+        tail += f"\n[output truncated: exceeded {LAB_EXEC_TIMEOUT:g}s time limit]\n"
+    if tail:
+        yield {'output': tail}
+    
+    exit_code = None
+    if truncated is None:
+        try:
+            exit_code = (await lab_orchestrator.run(docker_client.api.exec_inspect, exec_id)).get('ExitCode')
+        except Exception as e:
+            logger.error(f"Error inspecting exec {exec_id}: {e}")
+    yield {'exit_code': exit_code if exit_code is not None else 1, 'truncated': truncated}
 
 @api_router.post("/labs/{session_id}/execute")
-async def execute_command(session_id: str, command: Dict[str, str], current_user: dict = Depends(get_current_user)):
+async def execute_command(session_id: str, command: Dict[str, str], stream: bool = False, current_user: dict = Depends(get_current_user)):
     session = await db.lab_sessions.find_one({'id': session_id, 'user_id': current_user['id']}, {'_id': 0})
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
@@ -392,11 +1211,27 @@ async def execute_command(session_id: str, command: Dict[str, str], current_user
     cmd = command.get('command', '')
     
     if docker_client and session['container_id']:
+        events = stream_lab_exec(session['container_id'], current_user['id'], cmd)
+        if stream:
+            # NDJSON: one {"output": ...} line per chunk, then a final {"exit_code", "truncated"} line
+            async def ndjson():
+                try:
+                    async for event in events:
+                        yield json.dumps(event) + '\n'
+                except Exception as e:
+                    yield json.dumps({'output': f"Error: {str(e)}"}) + '\n'
+                    yield json.dumps({'exit_code': 1, 'truncated': None}) + '\n'
+            return StreamingResponse(ndjson(), media_type='application/x-ndjson')
+        
+        output = []
         try:
-            container = docker_client.containers.get(session['container_id'])
-            result = container.exec_run(f'/bin/bash -c "{cmd}"', stdout=True, stderr=True)
-            output = result.output.decode('utf-8', errors='replace') if result.output else ''
-            return {'output': output, 'exit_code': result.exit_code}
+            async for event in events:
+                if 'output' in event:
+                    output.append(event['output'])
+                else:
+                    return {'output': ''.join(output), 'exit_code': event['exit_code'], 'truncated': event['truncated']}
+        except HTTPException:
+            raise
         except Exception as e:
             return {'output': f"Error: {str(e)}", 'exit_code': 1}
     
@@ -409,55 +1244,201 @@ async def stop_lab(session_id: str, current_user: dict = Depends(get_current_use
         raise HTTPException(status_code=404, detail="Session not found")
     
     if docker_client and session.get('container_id'):
-        try:
-            container = docker_client.containers.get(session['container_id'])
-            container.stop()
-            container.remove()
-        except Exception as e:
-            logger.error(f"Error stopping container: {e}")
+        await close_lab_terminal(session_id)
+        async with lab_orchestrator.slot(current_user['id']):
+            try:
+                await lab_orchestrator.run(stop_and_remove_container, session['container_id'])
+            except Exception as e:
+                logger.error(f"Error stopping container: {e}")
     
     await db.lab_sessions.update_one(
-        {'id': session_id},
+        {'id': session_id, 'status': 'running'},
         {'$set': {'status': 'stopped', 'ended_at': datetime.now(timezone.utc).isoformat()}}
     )
     
     return {'message': 'Lab stopped'}
 
+class LabTerminal:
+    # One long-lived PTY shell per lab session. The exec socket is driven directly by
+    # the event loop, so keystrokes and output never touch the Docker executor; the
+    # shell outlives websocket reconnects and replays recent output on attach.
+    def __init__(self, session_id: str, exec_id: str, sock):
+        self.session_id = session_id
+        self.exec_id = exec_id
+        self.sock = sock
+        self.raw = getattr(sock, '_sock', sock)
+        self.raw.setblocking(False)
+        self.websocket: Optional[WebSocket] = None
+        self.scrollback = bytearray()
+        self.closed = False
+        self._reader = asyncio.create_task(self._pump_output())
+
+    async def _pump_output(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                data = await loop.sock_recv(self.raw, 4096)
+                if not data:
+                    break
+                self.scrollback += data
+                del self.scrollback[:-LAB_TERMINAL_SCROLLBACK]
+                if self.websocket:
+                    try:
+                        await self.websocket.send_bytes(data)
+                    except Exception:
+                        self.websocket = None
+        except Exception as e:
+            if not self.closed:
+                logger.error(f"Terminal output error for session {self.session_id}: {e}")
+        finally:
+            await self.close()
+
+    async def write(self, data: bytes):
+        await asyncio.get_running_loop().sock_sendall(self.raw, data)
+
+    async def resize(self, rows: int, cols: int):
+        await lab_orchestrator.run(docker_client.api.exec_resize, self.exec_id, height=rows, width=cols)
+
+    async def attach(self, websocket: WebSocket):
+        previous, self.websocket = self.websocket, websocket
+        if previous:
+            try:
+                await previous.close(code=4000, reason="Attached elsewhere")
+            except Exception:
+                pass
+        if self.scrollback:
+            await websocket.send_bytes(bytes(self.scrollback))
+
+    def detach(self, websocket: WebSocket):
+        if self.websocket is websocket:
+            self.websocket = None
+
+    async def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if lab_terminals.get(self.session_id) is self:
+            del lab_terminals[self.session_id]
+        if self._reader is not asyncio.current_task():
+            self._reader.cancel()
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+        if self.websocket:
+            try:
+                await self.websocket.close(code=1000, reason="Shell closed")
+            except Exception:
+                pass
+            self.websocket = None
+
+lab_terminals: Dict[str, LabTerminal] = {}
+# One in-flight shell open per session; opens for different sessions never wait on each other
+lab_terminal_opening: Dict[str, asyncio.Future] = {}
+
+def open_lab_shell(container_id: str):
+    exec_id = docker_client.api.exec_create(
+        container_id,
+        ['/bin/bash'],
+        stdin=True,
+        tty=True,
+        environment={'TERM': 'xterm-256color'}
+    )['Id']
+    sock = docker_client.api.exec_start(exec_id, socket=True, tty=True)
+    return exec_id, sock
+
+async def open_lab_terminal(session: Dict[str, Any]) -> LabTerminal:
+    async with lab_orchestrator.slot(session['user_id']):
+        exec_id, sock = await lab_orchestrator.run(open_lab_shell, session['container_id'])
+    terminal = LabTerminal(session['id'], exec_id, sock)
+    lab_terminals[session['id']] = terminal
+    return terminal
+
+async def get_lab_terminal(session: Dict[str, Any]) -> LabTerminal:
+    session_id = session['id']
+    terminal = lab_terminals.get(session_id)
+    if terminal is not None and not terminal.closed:
+        return terminal
+    opening = lab_terminal_opening.get(session_id)
+    if opening is None:
+        opening = lab_terminal_opening[session_id] = asyncio.ensure_future(open_lab_terminal(session))
+        opening.add_done_callback(lambda _: lab_terminal_opening.pop(session_id, None))
+    return await asyncio.shield(opening)
+
+async def close_lab_terminal(session_id: str):
+    terminal = lab_terminals.get(session_id)
+    if terminal:
+        await terminal.close()
+
+@api_router.websocket("/labs/{session_id}/terminal")
+async def lab_terminal(websocket: WebSocket, session_id: str, token: str):
+    # Binary frames are raw stdin. Text frames are JSON control messages:
+    # {"type": "input", "data": "..."} or {"type": "resize", "rows": 24, "cols": 80}
+    try:
+        user = await get_user_from_token(token)
+    except HTTPException:
+        await websocket.close(code=4401)
+        return
+    session = await db.lab_sessions.find_one(
+        {'id': session_id, 'user_id': user['id'], 'status': 'running'},
+        {'_id': 0}
+    )
+    if not session:
+        await websocket.close(code=4404)
+        return
+    
+    await websocket.accept()
+    if not docker_client or not session.get('container_id') or session['container_id'].startswith('mock-'):
+        await websocket.send_text("Docker not available\r\n")
+        await websocket.close()
+        return
+    
+    try:
+        terminal = await get_lab_terminal(session)
+    except HTTPException as e:
+        await websocket.close(code=1013, reason=e.detail)
+        return
+    except Exception as e:
+        logger.error(f"Error opening terminal for session {session_id}: {e}")
+        await websocket.close(code=1011, reason="Failed to open shell")
+        return
+    
+    await terminal.attach(websocket)
+    try:
+        while not terminal.closed:
+            message = await websocket.receive()
+            if message['type'] == 'websocket.disconnect':
+                break
+            if message.get('bytes'):
+                await terminal.write(message['bytes'])
+            elif message.get('text'):
+                try:
+                    control = json.loads(message['text'])
+                except ValueError:
+                    control = {'type': 'input', 'data': message['text']}
+                if control.get('type') == 'resize':
+                    await terminal.resize(int(control['rows']), int(control['cols']))
+                elif control.get('type') == 'input':
+                    await terminal.write(control.get('data', '').encode('utf-8'))
+    except Exception as e:
+        logger.info(f"Terminal websocket for session {session_id} closed: {e}")
+    finally:
+        terminal.detach(websocket)
+
 @api_router.post("/flags/submit")
 async def submit_flag(request: SubmitFlagRequest, current_user: dict = Depends(get_current_user)):
-    room = await db.rooms.find_one({'id': request.room_id}, {'_id': 0})
+    await rate_limiter.check('flags_submit', current_user['id'], room=request.room_id)
+    room = await catalog.room(request.room_id)
     if not room:
         raise HTTPException(status_code=404, detail="Room not found")
     
-    submitted_flag = request.flag
-    is_correct = submitted_flag in room.get('flags', [])
+    is_correct = flag_verifier.verify(request.room_id, request.flag)
     
     if is_correct:
-        progress = await db.user_progress.find_one(
-            {'user_id': current_user['id'], 'room_id': request.room_id},
-            {'_id': 0}
-        )
-        
-        if not progress:
-            progress = UserProgress(
-                user_id=current_user['id'],
-                room_id=request.room_id,
-                completed=True
-            )
-            progress_dict = progress.model_dump()
-            progress_dict['started_at'] = progress.started_at.isoformat()
-            progress_dict['completed_at'] = datetime.now(timezone.utc).isoformat()
-            await db.user_progress.insert_one(progress_dict)
-            
-            new_xp = current_user['xp'] + room.get('xp_reward', 100)
-            await db.users.update_one(
-                {'id': current_user['id']},
-                {'$set': {'xp': new_xp}, '$push': {'completed_rooms': request.room_id}}
-            )
-            
-            return {'correct': True, 'message': 'Flag correct! Room completed!', 'xp_earned': room.get('xp_reward', 100)}
-        else:
-            return {'correct': True, 'message': 'Flag correct! Already completed.'}
+        xp_reward = room.get('xp_reward', 100)
+        if await award_room_completion(current_user['id'], request.room_id, xp_reward):
+            return {'correct': True, 'message': 'Flag correct! Room completed!', 'xp_earned': xp_reward}
+        return {'correct': True, 'message': 'Flag correct! Already completed.'}
     
     return {'correct': False, 'message': 'Incorrect flag. Try again!'}
 
@@ -469,27 +1450,353 @@ async def get_challenges(language: Optional[str] = None):
     challenges = await db.coding_challenges.find(query, {'_id': 0}).to_list(100)
     return challenges
 
-@api_router.post("/challenges/execute")
-async def execute_code(code_data: Dict[str, str]):
-    language = code_data.get('language', 'python')
-    code = code_data.get('code', '')
-    
-    language_map = {
-        'python': 'python',
-        'javascript': 'javascript',
-        'bash': 'bash'
-    }
-    
-    piston_lang = language_map.get(language, 'python')
-    
+CODE_EXEC_BACKEND = os.environ.get('CODE_EXEC_BACKEND', 'docker')  # docker, local or piston
+if CODE_EXEC_BACKEND == 'docker' and docker_client is None:
+    logger.warning("CODE_EXEC_BACKEND=docker but Docker is unavailable; falling back to piston")
+    CODE_EXEC_BACKEND = 'piston'
+CODE_EXEC_WORKERS = int(os.environ.get('CODE_EXEC_WORKERS', str(os.cpu_count() or 2)))
+CODE_EXEC_TIMEOUT = float(os.environ.get('CODE_EXEC_TIMEOUT', '10'))
+CODE_EXEC_CPU_SECONDS = int(os.environ.get('CODE_EXEC_CPU_SECONDS', '5'))
+CODE_EXEC_MEMORY_MB = int(os.environ.get('CODE_EXEC_MEMORY_MB', '256'))
+CODE_EXEC_MAX_OUTPUT = int(os.environ.get('CODE_EXEC_MAX_OUTPUT', str(64 * 1024)))
+CODE_CACHE_MAX_ENTRIES = int(os.environ.get('CODE_CACHE_MAX_ENTRIES', '10000'))
+CODE_CACHE_MAX_BYTES = int(os.environ.get('CODE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+CODE_CACHE_PERSIST = os.environ.get('CODE_CACHE_PERSIST', 'false').lower() in ('1', 'true', 'yes')
+CODE_JOB_QUEUE_SIZE = int(os.environ.get('CODE_JOB_QUEUE_SIZE', '200'))
+CODE_JOB_RESULT_TTL = float(os.environ.get('CODE_JOB_RESULT_TTL', '600'))
+# The local backend gives each concurrent run its own UID from this range
+CODE_EXEC_UID_BASE = int(os.environ.get('CODE_EXEC_UID_BASE', '200000'))
+CODE_EXEC_IMAGES = {
+    'python': 'python:3.11-slim',
+    'javascript': 'node:20-slim',
+    'bash': 'bash:5.2',
+    **json.loads(os.environ.get('CODE_EXEC_IMAGES', '{}'))
+}
+CLONE_NEWNET = 0x40000000
+
+SANDBOX_LANGUAGES = {
+    'python': {'file': 'main.py', 'cmd': ['python3', '-I', '-S', 'main.py']},
+    'javascript': {'file': 'main.js', 'cmd': ['node', f'--max-old-space-size={CODE_EXEC_MEMORY_MB}', 'main.js']},
+    'bash': {'file': 'main.sh', 'cmd': ['bash', 'main.sh']}
+}
+
+class CodeSandbox:
+    # Runs untrusted snippets as throwaway subprocesses in a temp directory, at most
+    # `workers` at a time, with rlimits for CPU/memory/files and a wall-clock timeout.
+    # Output beyond max_output kills the run, so memory per run stays bounded.
+    #
+    # Each concurrent run gets its own UID from uid_base and its own empty network
+    # namespace, so runs cannot reach other services or each other's files and
+    # processes; once a run ends every process of its UID is killed, including any
+    # that left the process group. This needs root; check() refuses to start without it.
+    def __init__(self, workers: int, timeout: float, cpu_seconds: int, memory_mb: int, max_output: int, uid_base: int):
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory_bytes = memory_mb * 1024 * 1024
+        self.max_output = max_output
+        self.uids: asyncio.Queue = asyncio.Queue()
+        for uid in range(uid_base, uid_base + workers):
+            self.uids.put_nowait(uid)
+        self.libc = None
+
+    def check(self):
+        if os.geteuid() != 0:
+            raise RuntimeError("CODE_EXEC_BACKEND=local needs root to switch UIDs and unshare the network")
+        env_file = ROOT_DIR / '.env'
+        if env_file.exists() and env_file.stat().st_mode & 0o004:
+            raise RuntimeError(f"{env_file} is world-readable; sandboxed runs could read its secrets")
+        self.libc = ctypes.CDLL(None, use_errno=True)
+
+    def _preexec(self, language: str, uid: int):
+        def apply_limits():
+            if self.libc.unshare(CLONE_NEWNET) != 0:
+                raise OSError(ctypes.get_errno(), "unshare(CLONE_NEWNET) failed")
+            resource.setrlimit(resource.RLIMIT_CPU, (self.cpu_seconds, self.cpu_seconds + 1))
+            # V8 reserves far more address space than it uses; node is capped by --max-old-space-size
+            if language != 'javascript':
+                resource.setrlimit(resource.RLIMIT_AS, (self.memory_bytes, self.memory_bytes))
+            resource.setrlimit(resource.RLIMIT_FSIZE, (self.max_output, self.max_output))
+            resource.setrlimit(resource.RLIMIT_NOFILE, (64, 64))
+            resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+            resource.setrlimit(resource.RLIMIT_NPROC, (64, 64))
+            os.setgroups([])
+            os.setgid(uid)
+            os.setuid(uid)
+        return apply_limits
+
+    async def _kill_uid(self, uid: int):
+        # kill(-1) from inside the UID reaches every process that UID owns
+        def become():
+            os.setgid(uid)
+            os.setuid(uid)
+        proc = await asyncio.create_subprocess_exec(
+            '/bin/sh', '-c', 'kill -KILL -1',
+            preexec_fn=become
+        )
+        await proc.wait()
+
+    async def execute(self, language: str, code: str, stdin: str = '') -> Dict[str, Any]:
+        spec = SANDBOX_LANGUAGES[language]
+        uid = await self.uids.get()
+        try:
+            with tempfile.TemporaryDirectory(prefix='sandbox-') as workdir:
+                Path(workdir, spec['file']).write_text(code)
+                os.chown(workdir, uid, uid)
+                os.chown(Path(workdir, spec['file']), uid, uid)
+                proc = await asyncio.create_subprocess_exec(
+                    *spec['cmd'],
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                    cwd=workdir,
+                    env={'PATH': '/usr/local/bin:/usr/bin:/bin', 'HOME': workdir, 'LANG': 'C.UTF-8'},
+                    preexec_fn=self._preexec(language, uid),
+                    start_new_session=True
+                )
+                return await self._collect(proc, stdin, uid)
+        finally:
+            self.uids.put_nowait(uid)
+
+    async def _collect(self, proc, stdin: str, uid: int) -> Dict[str, Any]:
+        combined: List[bytes] = []
+        streams = {'stdout': [], 'stderr': []}
+        budget = [self.max_output]
+        limit_hit = []
+
+        def kill():
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+        async def pump(reader, name):
+            while True:
+                chunk = await reader.read(4096)
+                if not chunk:
+                    return
+                if budget[0] <= 0:
+                    continue
+                chunk = chunk[:budget[0]]
+                budget[0] -= len(chunk)
+                streams[name].append(chunk)
+                combined.append(chunk)
+                if budget[0] <= 0 and not limit_hit:
+                    limit_hit.append('output')
+                    kill()
+
+        async def feed():
+            try:
+                if stdin:
+                    proc.stdin.write(stdin.encode('utf-8'))
+                    await proc.stdin.drain()
+                proc.stdin.close()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        async def exited():
+            # proc.wait() also waits for the pipes, which stragglers may hold open
+            while proc.returncode is None:
+                await asyncio.sleep(0.02)
+
+        io_done = asyncio.gather(feed(), pump(proc.stdout, 'stdout'), pump(proc.stderr, 'stderr'))
+        try:
+            await asyncio.wait_for(exited(), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            limit_hit.append('time')
+            kill()
+            await proc.wait()
+        finally:
+            # Background processes left behind may still hold the pipes open
+            await asyncio.shield(self._kill_uid(uid))
+        await io_done
+
+        return self._result(streams, combined, limit_hit, proc.returncode)
+
+    def _result(self, streams, combined, limit_hit, returncode) -> Dict[str, Any]:
+        def decode(chunks):
+            return b''.join(chunks).decode('utf-8', errors='replace')
+
+        stderr = decode(streams['stderr'])
+        output = decode(combined)
+        if 'output' in limit_hit:
+            marker = f"\n[output truncated: exceeded {self.max_output} bytes]\n"
+            stderr += marker
+            output += marker
+        if 'time' in limit_hit:
+            marker = f"\n[time limit exceeded: {self.timeout:g}s]\n"
+            stderr += marker
+            output += marker
+        exit_code = returncode
+        if exit_code is not None and exit_code < 0:
+            exit_code = 128 - exit_code
+        return {
+            'output': output,
+            'stdout': decode(streams['stdout']),
+            'stderr': stderr,
+            'exit_code': exit_code if exit_code is not None else 1,
+            # Runs cut short by a limit depend on machine load, so they are never cached
+            'cacheable': not limit_hit and returncode is not None and returncode >= 0
+        }
+
+class ContainerSandbox(CodeSandbox):
+    # Runs each snippet in a throwaway container from CODE_EXEC_IMAGES with no network,
+    # an unprivileged user, a pids limit and the same CPU/memory/output/time limits as
+    # the local backend. Blocking Docker calls run on a pool of their own so code runs
+    # never take threads away from lab provisioning.
+    def __init__(self, workers: int, timeout: float, cpu_seconds: int, memory_mb: int, max_output: int):
+        super().__init__(0, timeout, cpu_seconds, memory_mb, max_output, 0)
+        self.semaphore = asyncio.Semaphore(workers)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='code-exec')
+
+    async def call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def _run(self, language: str, code: str, stdin: str, cancelled: threading.Event) -> Dict[str, Any]:
+        spec = SANDBOX_LANGUAGES[language]
+        container = docker_client.containers.create(
+            CODE_EXEC_IMAGES[language],
+            spec['cmd'],
+            working_dir='/sandbox',
+            user='65534:65534',
+            environment={'HOME': '/sandbox', 'LANG': 'C.UTF-8'},
+            network_mode='none',
+            mem_limit=self.memory_bytes,
+            memswap_limit=self.memory_bytes,
+            nano_cpus=1_000_000_000,
+            pids_limit=64,
+            cap_drop=['ALL'],
+            security_opt=['no-new-privileges'],
+            ulimits=[
+                docker.types.Ulimit(name='cpu', soft=self.cpu_seconds, hard=self.cpu_seconds + 1),
+                docker.types.Ulimit(name='fsize', soft=self.max_output, hard=self.max_output),
+                docker.types.Ulimit(name='nofile', soft=64, hard=64)
+            ],
+            stdin_open=True,
+            stdin_once=True
+        )
+        try:
+            archive = io.BytesIO()
+            with tarfile.open(fileobj=archive, mode='w') as tar:
+                folder = tarfile.TarInfo('sandbox')
+                folder.type = tarfile.DIRTYPE
+                folder.mode = 0o777
+                tar.addfile(folder)
+                source = code.encode('utf-8')
+                entry = tarfile.TarInfo(f"sandbox/{spec['file']}")
+                entry.size = len(source)
+                entry.mode = 0o644
+                tar.addfile(entry, io.BytesIO(source))
+            container.put_archive('/', archive.getvalue())
+
+            sock = container.attach_socket(params={'stdin': 1, 'stdout': 1, 'stderr': 1, 'stream': 1})
+            raw = getattr(sock, '_sock', sock)
+            container.start()
+            deadline = time.monotonic() + self.timeout
+            try:
+                raw.sendall(stdin.encode('utf-8'))
+            except OSError:
+                pass
+            raw.shutdown(socket.SHUT_WR)
+
+            # Attach output is multiplexed into 8-byte-header frames (stream, 0, 0, 0, size)
+            streams = {'stdout': [], 'stderr': []}
+            combined: List[bytes] = []
+            limit_hit = []
+            budget = self.max_output
+            buffer = b''
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    limit_hit.append('time')
+                    break
+                if cancelled.is_set():
+                    break
+                # Wake up periodically so a cancelled run stops and removes its container
+                raw.settimeout(min(remaining, 0.5))
+                try:
+                    data = raw.recv(65536)
+                except socket.timeout:
+                    continue
+                if not data:
+                    break
+                buffer += data
+                while len(buffer) >= 8:
+                    size = int.from_bytes(buffer[4:8], 'big')
+                    if len(buffer) < 8 + size:
+                        break
+                    name = 'stderr' if buffer[0] == 2 else 'stdout'
+                    chunk = buffer[8:8 + size][:budget]
+                    buffer = buffer[8 + size:]
+                    budget -= len(chunk)
+                    streams[name].append(chunk)
+                    combined.append(chunk)
+                if budget <= 0:
+                    limit_hit.append('output')
+                    break
+            sock.close()
+
+            returncode = None
+            if not limit_hit and not cancelled.is_set():
+                try:
+                    returncode = container.wait(timeout=max(deadline - time.monotonic(), 1))['StatusCode']
+                except Exception:
+                    limit_hit.append('time')
+            return self._result(streams, combined, limit_hit, returncode)
+        finally:
+            container.remove(force=True)
+
+    async def execute(self, language: str, code: str, stdin: str = '') -> Dict[str, Any]:
+        # The slot is held until the thread returns, not until the caller goes away, so
+        # a cancelled run still counts against the limit while its container is removed
+        await self.semaphore.acquire()
+        cancelled = threading.Event()
+        try:
+            run = asyncio.get_running_loop().run_in_executor(
+                self.executor, self._run, language, code, stdin, cancelled
+            )
+        except BaseException:
+            self.semaphore.release()
+            raise
+        run.add_done_callback(lambda _: self.semaphore.release())
+        try:
+            return await asyncio.shield(run)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    async def prepare(self):
+        # containers.create never pulls, so make sure every sandbox image is present
+        for image in set(CODE_EXEC_IMAGES.values()):
+            try:
+                try:
+                    await self.call(docker_client.images.get, image)
+                except NotFound:
+                    logger.info(f"Pulling code sandbox image {image}")
+                    await self.call(docker_client.images.pull, image)
+            except Exception as e:
+                logger.error(f"Failed to prepare code sandbox image {image}: {e}")
+
+if CODE_EXEC_BACKEND == 'local':
+    code_sandbox = CodeSandbox(
+        CODE_EXEC_WORKERS, CODE_EXEC_TIMEOUT, CODE_EXEC_CPU_SECONDS,
+        CODE_EXEC_MEMORY_MB, CODE_EXEC_MAX_OUTPUT, CODE_EXEC_UID_BASE
+    )
+else:
+    code_sandbox = ContainerSandbox(
+        CODE_EXEC_WORKERS, CODE_EXEC_TIMEOUT, CODE_EXEC_CPU_SECONDS,
+        CODE_EXEC_MEMORY_MB, CODE_EXEC_MAX_OUTPUT
+    )
+
+async def execute_with_piston(language: str, code: str, stdin: str = '') -> Dict[str, Any]:
     try:
         async with httpx.AsyncClient() as client:
             response = await client.post(
                 'https://emkc.org/api/v2/piston/execute',
                 json={
-                    'language': piston_lang,
+                    'language': language,
                     'version': '*',
-                    'files': [{'content': code}]
+                    'files': [{'content': code}],
+                    'stdin': stdin
                 },
                 timeout=30
             )
@@ -500,20 +1807,719 @@ async def execute_code(code_data: Dict[str, str]):
                     'output': result.get('run', {}).get('output', ''),
                     'stderr': result.get('run', {}).get('stderr', ''),
                     'stdout': result.get('run', {}).get('stdout', ''),
-                    'exit_code': result.get('run', {}).get('code', 0)
+                    'exit_code': result.get('run', {}).get('code', 0),
+                    'cacheable': result.get('run', {}).get('signal') is None
                 }
     except Exception as e:
         return {'output': '', 'stderr': f"Error: {str(e)}", 'stdout': '', 'exit_code': 1}
     
     return {'output': 'Execution service unavailable', 'stderr': '', 'stdout': '', 'exit_code': 1}
 
-@api_router.get("/leaderboard")
-async def get_leaderboard(limit: int = 10):
+class CodeResultCache:
+    # Content-addressed cache of execution results keyed by sha256(language, runtime
+    # version, limits, code, stdin). Memory is an LRU bounded by entry count and total
+    # bytes; with persist=True entries are also written to Mongo and survive restarts.
+    # Concurrent misses for the same key share one execution.
+    def __init__(self, max_entries: int, max_bytes: int, persist: bool):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.persist = persist
+        self.entries: OrderedDict = OrderedDict()
+        self.sizes: Dict[str, int] = {}
+        self.total_bytes = 0
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.waiters: Dict[str, int] = {}
+        self.runtime_versions: Dict[str, str] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def runtime_version(self, language: str) -> str:
+        if CODE_EXEC_BACKEND == 'piston':
+            return 'piston:*'
+        if CODE_EXEC_BACKEND == 'docker':
+            if language not in self.runtime_versions:
+                try:
+                    image = await code_sandbox.call(docker_client.images.get, CODE_EXEC_IMAGES[language])
+                    self.runtime_versions[language] = image.id
+                except Exception:
+                    return 'unknown'
+            return self.runtime_versions[language]
+        if language not in self.runtime_versions:
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    SANDBOX_LANGUAGES[language]['cmd'][0], '--version',
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.STDOUT
+                )
+                out, _ = await proc.communicate()
+                self.runtime_versions[language] = out.decode('utf-8', errors='replace').strip().splitlines()[0]
+            except Exception:
+                self.runtime_versions[language] = 'unknown'
+        return self.runtime_versions[language]
+
+    async def key(self, language: str, code: str, stdin: str) -> str:
+        version = await self.runtime_version(language)
+        limits = f"{CODE_EXEC_TIMEOUT}:{CODE_EXEC_CPU_SECONDS}:{CODE_EXEC_MEMORY_MB}:{CODE_EXEC_MAX_OUTPUT}"
+        digest = hashlib.sha256()
+        for part in (language, version, limits, code, stdin):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def _remember(self, key: str, result: Dict[str, Any]):
+        size = len(json.dumps(result))
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.total_bytes -= self.sizes[key]
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        self.sizes[key] = size
+        self.total_bytes += size
+        while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            evicted, _ = self.entries.popitem(last=False)
+            self.total_bytes -= self.sizes.pop(evicted)
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if self.persist:
+            doc = await db.code_exec_cache.find_one({'_id': key}, {'_id': 0, 'result': 1})
+            if doc:
+                self._remember(key, doc['result'])
+                return doc['result']
+        return None
+
+    async def put(self, key: str, result: Dict[str, Any]):
+        self._remember(key, result)
+        if self.persist:
+            await db.code_exec_cache.replace_one(
+                {'_id': key},
+                {'_id': key, 'result': result, 'created_at': datetime.now(timezone.utc).isoformat()},
+                upsert=True
+            )
+
+    async def run(self, language: str, code: str, stdin: str, execute) -> Dict[str, Any]:
+        key = await self.key(language, code, stdin)
+        cached = await self.get(key)
+        if cached is not None:
+            self.hits += 1
+            return dict(cached)
+        # The execution is its own task shared by every caller for this key, so one
+        # caller's cancellation (e.g. stop_on_failure) never cancels anyone else's
+        # result; it is only cancelled once no caller is waiting for it any more
+        run = self.inflight.get(key)
+        if run is None:
+            self.misses += 1
+            run = self.inflight[key] = asyncio.ensure_future(self._execute(key, execute))
+        self.waiters[key] = self.waiters.get(key, 0) + 1
+        try:
+            return dict(await asyncio.shield(run))
+        except asyncio.CancelledError:
+            if self.waiters[key] == 1 and not run.done():
+                run.cancel()
+            raise
+        finally:
+            self.waiters[key] -= 1
+            if not self.waiters[key]:
+                del self.waiters[key]
+                if self.inflight.get(key) is run:
+                    del self.inflight[key]
+
+    async def _execute(self, key: str, execute) -> Dict[str, Any]:
+        result = await execute()
+        if result.pop('cacheable', False):
+            await self.put(key, result)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'entries': len(self.entries),
+            'bytes': self.total_bytes,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+code_cache = CodeResultCache(CODE_CACHE_MAX_ENTRIES, CODE_CACHE_MAX_BYTES, CODE_CACHE_PERSIST)
+
+async def dispatch_code(language: str, code: str, stdin: str = '') -> Dict[str, Any]:
+    if CODE_EXEC_BACKEND == 'piston':
+        return await execute_with_piston(language, code, stdin)
+    try:
+        return await code_sandbox.execute(language, code, stdin)
+    except Exception as e:
+        logger.error(f"Sandbox error: {e}")
+        return {'output': '', 'stderr': f"Error: {str(e)}", 'stdout': '', 'exit_code': 1}
+
+async def run_code(language: str, code: str, stdin: str = '', use_cache: bool = True) -> Dict[str, Any]:
+    if language not in SANDBOX_LANGUAGES:
+        language = 'python'
+    if not use_cache:
+        result = await dispatch_code(language, code, stdin)
+        result.pop('cacheable', None)
+        return result
+    return await code_cache.run(language, code, stdin, lambda: dispatch_code(language, code, stdin))
+
+@api_router.post("/challenges/execute")
+async def execute_code(code_data: Dict[str, Any], current_user: dict = Depends(get_current_user)):
+    # Pass "cache": false for programs whose output is not a pure function of code + stdin
+    return await run_code(
+        code_data.get('language', 'python'),
+        code_data.get('code', ''),
+        code_data.get('stdin', ''),
+        use_cache=code_data.get('cache', True) is not False
+    )
+
+async def grade_test_case(language: str, code: str, index: int, case: Dict[str, Any]) -> Dict[str, Any]:
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    result = await run_code(language, code, str(case.get('input', '')))
+    expected = str(case.get('expected', '')).strip()
+    actual = result['stdout'].strip()
+    return {
+        'index': index,
+        'passed': result['exit_code'] == 0 and actual == expected,
+        'expected': expected,
+        'actual': actual,
+        'stderr': result['stderr'],
+        'exit_code': result['exit_code'],
+        'time_ms': round((loop.time() - started) * 1000, 1)
+    }
+
+async def load_gradable_challenge(challenge_id: str) -> Dict[str, Any]:
+    challenge = await db.coding_challenges.find_one({'id': challenge_id}, {'_id': 0})
+    if not challenge:
+        raise HTTPException(status_code=404, detail="Challenge not found")
+    if not challenge.get('test_cases'):
+        raise HTTPException(status_code=400, detail="Challenge has no test cases")
+    return challenge
+
+async def grade_submission(challenge: Dict[str, Any], code: str, stop_on_failure: bool, user_id: str) -> Dict[str, Any]:
+    test_cases = challenge['test_cases']
+    
+    # All cases run in parallel across sandbox workers; with stop_on_failure the
+    # first failing case cancels whatever is still running and those are skipped
+    tasks = [
+        asyncio.create_task(grade_test_case(challenge['language'], code, i, case))
+        for i, case in enumerate(test_cases)
+    ]
+    results: Dict[int, Dict[str, Any]] = {}
+    try:
+        for finished in asyncio.as_completed(tasks):
+            result = await finished
+            results[result['index']] = result
+            if stop_on_failure and not result['passed']:
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+    
+    cases = [results.get(i, {'index': i, 'passed': False, 'skipped': True}) for i in range(len(test_cases))]
+    passed = sum(1 for case in cases if case['passed'])
+    all_passed = passed == len(test_cases)
+    
+    xp_earned = 0
+    if all_passed:
+        result = await db.users.update_one(
+            {'id': user_id, 'completed_challenges': {'$ne': challenge['id']}},
+            {'$inc': {'xp': challenge.get('xp_reward', 50)}, '$addToSet': {'completed_challenges': challenge['id']}}
+        )
+        if result.modified_count:
+            record_xp_award(user_id, challenge.get('xp_reward', 50))
+            xp_earned = challenge.get('xp_reward', 50)
+    
+    return {
+        'challenge_id': challenge['id'],
+        'passed': all_passed,
+        'passed_count': passed,
+        'total': len(test_cases),
+        'cases': cases,
+        'xp_earned': xp_earned
+    }
+
+@api_router.post("/challenges/{challenge_id}/grade")
+async def grade_challenge(challenge_id: str, submission: GradeSubmissionRequest, current_user: dict = Depends(get_current_user)):
+    challenge = await load_gradable_challenge(challenge_id)
+    return await grade_submission(challenge, submission.code, submission.stop_on_failure, current_user['id'])
+
+class CodeJobQueue:
+    # Job-based code execution. Graded submissions and scratch runs wait in separate
+    # bounded lanes; workers always drain the graded lane first. A full lane is
+    # rejected with 429 and a Retry-After estimated from recent run times.
+    #
+    # The worker process that accepts a job runs it, but every status change and the
+    # result are also written to the code_jobs collection (expired by TTL), so a poll
+    # or event stream that lands on another worker reads the job from Mongo instead.
+    LANES = ('graded', 'scratch')
+    TERMINAL = ('done', 'failed')
+
+    def __init__(self, workers: int, max_queue: int, result_ttl: float):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.result_ttl = result_ttl
+        self.lanes: Dict[str, deque] = {lane: deque() for lane in self.LANES}
+        self.enqueued = {lane: 0 for lane in self.LANES}
+        self.dequeued = {lane: 0 for lane in self.LANES}
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        self.events: Dict[str, asyncio.Event] = {}
+        self.finished: deque = deque()
+        self.avg_run_seconds = 1.0
+        self._pending = asyncio.Semaphore(0)
+        self._tasks: List[asyncio.Task] = []
+
+    def retry_after(self, lane: str) -> int:
+        waiting = len(self.lanes['graded']) + (len(self.lanes[lane]) if lane == 'scratch' else 0)
+        return max(1, int(waiting * self.avg_run_seconds / max(self.workers, 1)) + 1)
+
+    async def _persist(self, job: Dict[str, Any]):
+        try:
+            await db.code_jobs.update_one(
+                {'_id': job['id']},
+                {'$set': {
+                    **{k: v for k, v in job.items() if k != 'seq'},
+                    'queue_position': self.queue_position(job),
+                    'expires_at': datetime.now(timezone.utc) + timedelta(seconds=self.result_ttl)
+                }},
+                upsert=True
+            )
+        except Exception as e:
+            logger.error(f"Error saving code job {job['id']}: {e}")
+
+    async def submit(self, lane: str, user_id: str, run) -> Dict[str, Any]:
+        self._prune()
+        if len(self.lanes[lane]) >= self.max_queue:
+            raise HTTPException(
+                status_code=429,
+                detail="Execution queue is full, retry later",
+                headers={'Retry-After': str(self.retry_after(lane))}
+            )
+        job = {
+            'id': str(uuid.uuid4()),
+            'lane': lane,
+            'user_id': user_id,
+            'status': 'queued',
+            'seq': self.enqueued[lane],
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'result': None
+        }
+        self.enqueued[lane] += 1
+        self.jobs[job['id']] = job
+        self.events[job['id']] = asyncio.Event()
+        # Saved before a worker can pick it up, so later status writes always land last
+        await self._persist(job)
+        self.lanes[lane].append((job, run))
+        self._pending.release()
+        return self.view(job)
+
+    def queue_position(self, job: Dict[str, Any]) -> Optional[int]:
+        if job['status'] != 'queued':
+            return None
+        if 'seq' not in job:
+            # Owned by another worker: the position as of its last status change
+            return job.get('queue_position')
+        position = job['seq'] - self.dequeued[job['lane']] + 1
+        if job['lane'] == 'scratch':
+            position += len(self.lanes['graded'])
+        return position
+
+    def view(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'job_id': job['id'],
+            'lane': job['lane'],
+            'status': job['status'],
+            'queue_position': self.queue_position(job),
+            'created_at': job['created_at'],
+            'result': job['result']
+        }
+
+    async def get(self, job_id: str, user_id: str) -> Dict[str, Any]:
+        job = self.jobs.get(job_id)
+        if job is None:
+            job = await db.code_jobs.find_one({'_id': job_id}, {'_id': 0, 'expires_at': 0})
+        if not job or job['user_id'] != user_id:
+            raise HTTPException(status_code=404, detail="Job not found")
+        return job
+
+    async def wait(self, job: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+        # Returns the job once its status changes or the timeout passes
+        event = self.events.get(job['id'])
+        if event and job['id'] in self.jobs:
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            return job
+        deadline = asyncio.get_running_loop().time() + timeout
+        while asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.5)
+            current = await db.code_jobs.find_one({'_id': job['id']}, {'_id': 0, 'expires_at': 0})
+            if current is None or current['status'] != job['status']:
+                return current or job
+        return job
+
+    def _prune(self):
+        cutoff = asyncio.get_running_loop().time() - self.result_ttl
+        while self.finished and self.finished[0][0] < cutoff:
+            _, job_id = self.finished.popleft()
+            self.jobs.pop(job_id, None)
+            self.events.pop(job_id, None)
+
+    def _notify(self, job: Dict[str, Any]):
+        # Wake current waiters and arm a fresh event for the next status change
+        event = self.events.get(job['id'])
+        if event:
+            event.set()
+            if job['status'] not in ('done', 'failed'):
+                self.events[job['id']] = asyncio.Event()
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._pending.acquire()
+            lane = next(lane for lane in self.LANES if self.lanes[lane])
+            job, run = self.lanes[lane].popleft()
+            self.dequeued[lane] += 1
+            job['status'] = 'running'
+            self._notify(job)
+            await self._persist(job)
+            started = loop.time()
+            try:
+                job['result'] = await run()
+                job['status'] = 'done'
+            except HTTPException as e:
+                job['result'] = {'detail': e.detail}
+                job['status'] = 'failed'
+            except Exception as e:
+                logger.error(f"Code job {job['id']} failed: {e}")
+                job['result'] = {'detail': str(e)}
+                job['status'] = 'failed'
+            self.avg_run_seconds = 0.8 * self.avg_run_seconds + 0.2 * (loop.time() - started)
+            self.finished.append((loop.time(), job['id']))
+            self._notify(job)
+            await self._persist(job)
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'workers': self.workers,
+            'max_queue': self.max_queue,
+            'queued': {lane: len(self.lanes[lane]) for lane in self.LANES},
+            'avg_run_seconds': round(self.avg_run_seconds, 3)
+        }
+
+code_jobs = CodeJobQueue(CODE_EXEC_WORKERS, CODE_JOB_QUEUE_SIZE, CODE_JOB_RESULT_TTL)
+
+@api_router.post("/challenges/jobs", status_code=202)
+async def submit_code_job(job_data: Dict[str, Any], current_user: dict = Depends(get_current_user)):
+    # {"challenge_id", "code", "stop_on_failure"} queues a graded submission;
+    # {"language", "code", "stdin", "cache"} queues a scratch run
+    code = job_data.get('code', '')
+    if job_data.get('challenge_id'):
+        challenge = await load_gradable_challenge(job_data['challenge_id'])
+        stop_on_failure = bool(job_data.get('stop_on_failure', False))
+        return await code_jobs.submit(
+            'graded', current_user['id'],
+            lambda: grade_submission(challenge, code, stop_on_failure, current_user['id'])
+        )
+    
+    language = job_data.get('language', 'python')
+    stdin = job_data.get('stdin', '')
+    use_cache = job_data.get('cache', True) is not False
+    return await code_jobs.submit('scratch', current_user['id'], lambda: run_code(language, code, stdin, use_cache))
+
+@api_router.get("/challenges/jobs/{job_id}")
+async def get_code_job(job_id: str, wait: float = 0, current_user: dict = Depends(get_current_user)):
+    job = await code_jobs.get(job_id, current_user['id'])
+    if wait > 0 and job['status'] not in code_jobs.TERMINAL:
+        job = await code_jobs.wait(job, min(wait, 30))
+    return code_jobs.view(job)
+
+@api_router.get("/challenges/jobs/{job_id}/events")
+async def stream_code_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    job = await code_jobs.get(job_id, current_user['id'])
+    
+    async def events():
+        # Server-sent events: one "status" event per change (and every 15 s while queued
+        # so the position stays fresh), ending with the final job including its result
+        current = job
+        while True:
+            view = code_jobs.view(current)
+            yield f"event: status\ndata: {json.dumps(view)}\n\n"
+            if current['status'] in code_jobs.TERMINAL:
+                return
+            current = await code_jobs.wait(current, 15)
+    
+    return StreamingResponse(events(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+class RankedLeaderboard:
+    # Order-statistic view of users by XP: a sorted array of (-xp, user_id) keys, so
+    # rank lookups are a bisect and top-N/neighbour queries are slices. XP awards
+    # move one key; the whole structure is rebuilt from Mongo at startup and
+    # periodically to pick up awards made by other workers.
+    PROFILE_FIELDS = ('username', 'level', 'badges')
+
+    def __init__(self, profiles: Optional[Dict[str, Dict[str, Any]]] = None):
+        self.keys: List[tuple] = []
+        self.xp: Dict[str, int] = {}
+        # Windowed boards borrow the all-time board's profiles instead of keeping their own
+        self.owns_profiles = profiles is None
+        self.profiles: Dict[str, Dict[str, Any]] = {} if profiles is None else profiles
+
+    def rebuild(self, users: List[Dict[str, Any]]):
+        self.xp = {u['id']: u.get('xp', 0) for u in users}
+        if self.owns_profiles:
+            self.profiles.clear()
+            self.profiles.update({u['id']: {f: u.get(f) for f in self.PROFILE_FIELDS} for u in users})
+        self.keys = sorted((-xp, user_id) for user_id, xp in self.xp.items())
+
+    def _set_xp(self, user_id: str, xp: int):
+        if user_id in self.xp:
+            old_key = (-self.xp[user_id], user_id)
+            del self.keys[bisect.bisect_left(self.keys, old_key)]
+        self.xp[user_id] = xp
+        bisect.insort(self.keys, (-xp, user_id))
+
+    def update(self, user: Dict[str, Any]):
+        self.profiles[user['id']] = {f: user.get(f) for f in self.PROFILE_FIELDS}
+        self._set_xp(user['id'], user.get('xp', 0))
+
+    def add_xp(self, user_id: str, amount: int):
+        if user_id in self.xp:
+            self._set_xp(user_id, self.xp[user_id] + amount)
+
+    def increment(self, user_id: str, amount: int):
+        self._set_xp(user_id, self.xp.get(user_id, 0) + amount)
+
+    def remove(self, user_id: str):
+        if user_id in self.xp:
+            del self.keys[bisect.bisect_left(self.keys, (-self.xp.pop(user_id), user_id))]
+        if self.owns_profiles:
+            self.profiles.pop(user_id, None)
+
+    def rank(self, user_id: str) -> Optional[int]:
+        if user_id not in self.xp:
+            return None
+        return bisect.bisect_left(self.keys, (-self.xp[user_id], user_id)) + 1
+
+    def entry(self, index: int) -> Dict[str, Any]:
+        neg_xp, user_id = self.keys[index]
+        return {'id': user_id, **self.profiles.get(user_id, {}), 'xp': -neg_xp, 'rank': index + 1}
+
+    def top(self, limit: int, offset: int = 0) -> List[Dict[str, Any]]:
+        return [self.entry(i) for i in range(offset, min(offset + limit, len(self.keys)))]
+
+    def around(self, user_id: str, radius: int) -> List[Dict[str, Any]]:
+        rank = self.rank(user_id)
+        if rank is None:
+            return []
+        start = max(rank - 1 - radius, 0)
+        return [self.entry(i) for i in range(start, min(rank + radius, len(self.keys)))]
+
+leaderboard = RankedLeaderboard()
+
+def window_bucket(window: str, when: datetime) -> tuple:
+    # Returns (bucket key, bucket end) for the weekly (ISO week) or monthly window containing `when`
+    if window == 'weekly':
+        iso = when.isocalendar()
+        start = datetime(when.year, when.month, when.day, tzinfo=timezone.utc) - timedelta(days=iso.weekday - 1)
+        return f"{iso.year}-W{iso.week:02d}", start + timedelta(days=7)
+    if when.month == 12:
+        end = datetime(when.year + 1, 1, 1, tzinfo=timezone.utc)
+    else:
+        end = datetime(when.year, when.month + 1, 1, tzinfo=timezone.utc)
+    return f"{when.year}-{when.month:02d}", end
+
+class WindowedLeaderboards:
+    # XP awards are also added to one aggregate per (window, bucket, user) in xp_windows,
+    # so weekly/monthly standings never scan submissions. The current bucket of each
+    # window is mirrored in memory and replaced when the clock rolls into a new bucket.
+    # Past buckets are read from the aggregates until their TTL (bucket end + retention) expires.
+    WINDOWS = ('weekly', 'monthly')
+
+    def __init__(self, retention_days: int):
+        self.retention = timedelta(days=retention_days)
+        self.current: Dict[str, tuple] = {}
+
+    def board(self, window: str) -> tuple:
+        bucket, _ = window_bucket(window, datetime.now(timezone.utc))
+        current = self.current.get(window)
+        if current is None or current[0] != bucket:
+            current = (bucket, RankedLeaderboard(profiles=leaderboard.profiles))
+            self.current[window] = current
+        return current
+
+    async def record(self, user_id: str, amount: int):
+        now = datetime.now(timezone.utc)
+        operations = []
+        for window in self.WINDOWS:
+            bucket, end = window_bucket(window, now)
+            operations.append(UpdateOne(
+                {'window': window, 'bucket': bucket, 'user_id': user_id},
+                {'$inc': {'xp': amount}, '$setOnInsert': {'expires_at': end + self.retention}},
+                upsert=True
+            ))
+            self.board(window)[1].increment(user_id, amount)
+        await db.xp_windows.bulk_write(operations, ordered=False)
+
+    async def rebuild(self):
+        for window in self.WINDOWS:
+            bucket, board = self.board(window)
+            rows = await db.xp_windows.find(
+                {'window': window, 'bucket': bucket},
+                {'_id': 0, 'user_id': 1, 'xp': 1}
+            ).to_list(None)
+            board.rebuild([{'id': r['user_id'], 'xp': r['xp']} for r in rows])
+
+    async def remove(self, user_id: str):
+        for _, board in self.current.values():
+            board.remove(user_id)
+        await db.xp_windows.delete_many({'user_id': user_id})
+
+    async def top(self, window: str, bucket: Optional[str], limit: int, offset: int) -> List[Dict[str, Any]]:
+        current_bucket, board = self.board(window)
+        if bucket is None or bucket == current_bucket:
+            return board.top(limit, offset)
+        rows = await db.xp_windows.find(
+            {'window': window, 'bucket': bucket},
+            {'_id': 0, 'user_id': 1, 'xp': 1}
+        ).sort([('xp', -1), ('user_id', 1)]).skip(offset).limit(limit).to_list(limit)
+        return [
+            {'id': r['user_id'], **leaderboard.profiles.get(r['user_id'], {}), 'xp': r['xp'], 'rank': offset + i + 1}
+            for i, r in enumerate(rows)
+        ]
+
+windowed_leaderboards = WindowedLeaderboards(LEADERBOARD_WINDOW_RETENTION_DAYS)
+
+def resolve_leaderboard(window: str) -> RankedLeaderboard:
+    if window == 'all':
+        return leaderboard
+    if window in WindowedLeaderboards.WINDOWS:
+        return windowed_leaderboards.board(window)[1]
+    raise HTTPException(status_code=400, detail="window must be one of: all, weekly, monthly")
+
+background_writes: set = set()
+
+async def record_windowed_xp(user_id: str, amount: int):
+    try:
+        await windowed_leaderboards.record(user_id, amount)
+    except Exception as e:
+        logger.error(f"Failed to record windowed XP for {user_id}: {e}")
+
+def record_xp_award(user_id: str, amount: int):
+    principal_cache.invalidate(user_id)
+    leaderboard.add_xp(user_id, amount)
+    # Window aggregates are off the request path so awards stay within two round-trips
+    task = asyncio.create_task(record_windowed_xp(user_id, amount))
+    background_writes.add(task)
+    task.add_done_callback(background_writes.discard)
+
+# Unique indexes the award claims rely on. Without them a claim never collides, so
+# every resubmission would award again; awards stay off until both are verified.
+XP_CLAIM_INDEXES = (
+    ('user_progress', 'user_id_1_room_id_1'),
+    ('flag_submissions', 'flag_id_1_user_id_1'),
+)
+xp_awards_enabled = False
+
+async def verify_claim_indexes() -> bool:
+    for collection, name in XP_CLAIM_INDEXES:
+        index = (await db[collection].index_information()).get(name)
+        if not index or not index.get('unique'):
+            logger.error(f"XP awards disabled: unique index {collection}.{name} is missing")
+            return False
+    return True
+
+def require_xp_awards():
+    if not xp_awards_enabled:
+        raise HTTPException(status_code=503, detail="XP awards are temporarily unavailable")
+
+async def award_xp_once(claim, user_id: str, amount: int, room_id: Optional[str] = None) -> bool:
+    # `claim` starts the idempotent write for this award, guarded by a unique index; if
+    # it hits a duplicate key the award was already made and nothing else is written.
+    # Otherwise XP is applied with $inc so concurrent awards can never lose each other.
+    # It is a callable because Motor issues a write as soon as it is called.
+    require_xp_awards()
+    try:
+        await claim()
+    except DuplicateKeyError:
+        return False
+    update: Dict[str, Any] = {'$inc': {'xp': amount}}
+    if room_id:
+        update['$addToSet'] = {'completed_rooms': room_id}
+    await db.users.update_one({'id': user_id}, update)
+    record_xp_award(user_id, amount)
+    return True
+
+async def award_room_completion(user_id: str, room_id: str, amount: int) -> bool:
+    # Marks an existing in-progress record complete or inserts a completed one. An
+    # already-completed record misses the filter, so the upsert collides with the
+    # unique (user_id, room_id) index instead of awarding twice.
+    progress = UserProgress(user_id=user_id, room_id=room_id, completed=True)
+    now = datetime.now(timezone.utc).isoformat()
+    claim = partial(
+        db.user_progress.update_one,
+        {'user_id': user_id, 'room_id': room_id, 'completed': {'$ne': True}},
+        {
+            '$set': {'completed': True, 'completed_at': now},
+            '$setOnInsert': {
+                'id': progress.id,
+                'completed_tasks': [],
+                'submitted_flags': [],
+                'started_at': progress.started_at.isoformat()
+            }
+        },
+        upsert=True
+    )
+    return await award_xp_once(claim, user_id, amount, room_id=room_id)
+
+async def rebuild_leaderboard():
     users = await db.users.find(
         {},
         {'_id': 0, 'id': 1, 'username': 1, 'xp': 1, 'level': 1, 'badges': 1}
-    ).sort('xp', -1).limit(limit).to_list(limit)
-    return users
+    ).to_list(None)
+    leaderboard.rebuild(users)
+    await windowed_leaderboards.rebuild()
+
+async def run_leaderboard_rebuilds():
+    while True:
+        await asyncio.sleep(LEADERBOARD_REBUILD_INTERVAL)
+        try:
+            await rebuild_leaderboard()
+        except Exception as e:
+            logger.error(f"Leaderboard rebuild failed: {e}")
+
+@api_router.get("/leaderboard")
+async def get_leaderboard(limit: int = 10, offset: int = 0, window: str = 'all', bucket: Optional[str] = None):
+    limit = min(max(limit, 0), 100)
+    offset = max(offset, 0)
+    if window == 'all':
+        return leaderboard.top(limit, offset)
+    resolve_leaderboard(window)
+    return await windowed_leaderboards.top(window, bucket, limit, offset)
+
+@api_router.get("/leaderboard/rank/{user_id}")
+async def get_leaderboard_rank(user_id: str, window: str = 'all'):
+    board = resolve_leaderboard(window)
+    rank = board.rank(user_id)
+    if rank is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return {'user_id': user_id, 'rank': rank, 'xp': board.xp[user_id], 'total': len(board.keys), 'window': window}
+
+@api_router.get("/leaderboard/around/{user_id}")
+async def get_leaderboard_around(user_id: str, radius: int = 5, window: str = 'all'):
+    entries = resolve_leaderboard(window).around(user_id, min(max(radius, 0), 50))
+    if not entries:
+        raise HTTPException(status_code=404, detail="User not found")
+    return entries
 
 @api_router.get("/profile/{user_id}")
 async def get_profile(user_id: str):
@@ -536,13 +2542,90 @@ async def get_user_progress(current_user: dict = Depends(get_current_user)):
     ).to_list(1000)
     return progress
 
+# Columns written by /admin/users/export
+USER_EXPORT_FIELDS = ('id', 'username', 'email', 'role', 'xp', 'level', 'created_at')
+
+def admin_user_query(role: Optional[str], min_xp: Optional[int], max_xp: Optional[int]) -> Dict[str, Any]:
+    query: Dict[str, Any] = {}
+    if role:
+        query['role'] = role
+    xp_range = {}
+    if min_xp is not None:
+        xp_range['$gte'] = min_xp
+    if max_xp is not None:
+        xp_range['$lte'] = max_xp
+    if xp_range:
+        query['xp'] = xp_range
+    return query
+
 @api_router.get("/admin/users")
-async def get_all_users(current_user: dict = Depends(get_current_user)):
+async def get_all_users(
+    response: Response,
+    role: Optional[str] = None,
+    min_xp: Optional[int] = None,
+    max_xp: Optional[int] = None,
+    cursor: Optional[str] = None,
+    limit: int = 100,
+    current_user: dict = Depends(get_current_user)
+):
     if current_user['role'] != 'admin':
         raise HTTPException(status_code=403, detail="Admin only")
-    users = await db.users.find({}, {'_id': 0, 'hashed_password': 0}).to_list(1000)
+    # Keyset pagination on the unique user id; the X-Next-Cursor response header,
+    # when present, is the cursor for the following page
+    limit = min(max(limit, 1), 1000)
+    query = admin_user_query(role, min_xp, max_xp)
+    if cursor:
+        query['id'] = {'$gt': cursor}
+    users = await db.users.find(
+        query, {'_id': 0, 'hashed_password': 0}
+    ).sort('id', 1).limit(limit + 1).to_list(limit + 1)
+    if len(users) > limit:
+        users = users[:limit]
+        response.headers['X-Next-Cursor'] = users[-1]['id']
     return users
 
+@api_router.get("/admin/users/export")
+async def export_users(
+    format: str = 'ndjson',
+    role: Optional[str] = None,
+    min_xp: Optional[int] = None,
+    max_xp: Optional[int] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    if current_user['role'] != 'admin':
+        raise HTTPException(status_code=403, detail="Admin only")
+    if format not in ('ndjson', 'csv'):
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+    
+    # Streams straight off the Motor cursor, one batch at a time, so memory stays
+    # flat however many users match
+    users = db.users.find(
+        admin_user_query(role, min_xp, max_xp),
+        {'_id': 0, **{field: 1 for field in USER_EXPORT_FIELDS}}
+    ).sort('id', 1).batch_size(1000)
+    
+    async def ndjson():
+        async for user in users:
+            yield json.dumps(user, default=str) + '\n'
+    
+    async def csv_rows():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(USER_EXPORT_FIELDS)
+        async for user in users:
+            writer.writerow([user.get(field, '') for field in USER_EXPORT_FIELDS])
+            if buffer.tell() >= 65536:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    
+    return StreamingResponse(
+        ndjson() if format == 'ndjson' else csv_rows(),
+        media_type='application/x-ndjson' if format == 'ndjson' else 'text/csv',
+        headers={'Content-Disposition': f'attachment; filename="users.{format}"'}
+    )
+
 @api_router.put("/admin/users/{user_id}/role")
 async def update_user_role(user_id: str, role_data: Dict[str, str], current_user: dict = Depends(get_current_user)):
     if current_user['role'] != 'admin':
@@ -550,6 +2633,7 @@ async def update_user_role(user_id: str, role_data: Dict[str, str], current_user
     result = await db.users.update_one({'id': user_id}, {'$set': {'role': role_data['role']}})
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    principal_cache.invalidate(user_id)
     return {'message': 'Role updated'}
 
 @api_router.delete("/admin/users/{user_id}")
@@ -557,10 +2641,210 @@ async def delete_user(user_id: str, current_user: dict = Depends(get_current_use
     if current_user['role'] != 'admin':
         raise HTTPException(status_code=403, detail="Admin only")
     result = await db.users.delete_one({'id': user_id})
+    principal_cache.invalidate(user_id)
+    leaderboard.remove(user_id)
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    await windowed_leaderboards.remove(user_id)
+    platform_stats.adjust('total_users', -1)
     return {'message': 'User deleted'}
 
+class LabFileStore:
+    # Content-addressed store for lab files at blobs/<digest[:2]>/<digest>. Uploads are
+    # streamed in chunks to a temp file and hashed as they arrive, then renamed onto
+    # their SHA-256, so a file uploaded to several rooms is stored once. Rooms refer
+    # to blobs by digest; a blob is removed once no room references it.
+    #
+    # Uploads write the room reference before committing the blob, and collect() moves
+    # a blob aside and re-checks references before deleting it, so a blob that another
+    # upload (in any worker) starts referencing meanwhile is always put back.
+    #
+    # Each room's file set is also packed once into archives/<key>.tar, keyed by the
+    # hash of its (filename, digest) pairs, so a changed file set gets a new archive
+    # and lab startup only streams one prebuilt tar into the container. Every catalog
+    # reload sweeps archives no room's current file set maps to; an archive is touched
+    # whenever a lab start uses it and only swept once unused for LAB_ARCHIVE_GRACE,
+    # so a start in another worker never loses the file it is about to open.
+    ARCHIVE_LAYOUT = 2
+
+    def __init__(self, root: Path, archive_dir: Path, max_bytes: int, chunk_size: int):
+        self.root = root
+        self.tmp_dir = root / 'tmp'
+        self.archive_dir = archive_dir
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='lab-files')
+        self.building: Dict[str, asyncio.Future] = {}
+        self.sweeping: Optional[asyncio.Future] = None
+
+    def path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(fn, *args))
+
+    def commit_blob(self, tmp_path: str, digest: str):
+        # Always replaces: an existing copy has the same content but may be mid-collect
+        target = self.path(digest)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp_path, target)
+
+    def move(self, source: Path, target: Path) -> bool:
+        try:
+            os.replace(source, target)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def remove_file(self, path: Path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    async def stage(self, upload: UploadFile):
+        # Returns the room entry and the temp file to pass to commit_blob once the
+        # room references it. Starlette has already spooled the multipart body by the
+        # time this runs, so max_bytes bounds what lands in the blob store rather than
+        # what the request may send; cap request bodies at the proxy for that.
+        await self.run(partial(self.tmp_dir.mkdir, parents=True, exist_ok=True))
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        out = os.fdopen(fd, 'wb')
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            while chunk := await upload.read(self.chunk_size):
+                size += len(chunk)
+                if size > self.max_bytes:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"{upload.filename} exceeds the {self.max_bytes}-byte upload limit"
+                    )
+                digest.update(chunk)
+                await self.run(out.write, chunk)
+            await self.run(out.close)
+        except BaseException:
+            out.close()
+            await self.run(self.remove_file, Path(tmp_path))
+            raise
+        return {'filename': Path(upload.filename).name, 'digest': digest.hexdigest(), 'size': size}, tmp_path
+
+    def source(self, entry: Dict[str, Any]) -> Path:
+        # Uploads from before the blob store only carry the path they were written to
+        return self.path(entry['digest']) if entry.get('digest') else Path(entry['path'])
+
+    def archive_key(self, files: List[Dict[str, Any]]) -> str:
+        members = sorted(
+            (f['filename'], f.get('digest') or f"path:{f.get('path')}:{f.get('size')}")
+            for f in files
+        )
+        # The layout version is hashed in so a change to how members are written
+        # (ownership, modes) never reuses an archive built the old way
+        return hashlib.sha256(json.dumps([self.ARCHIVE_LAYOUT, members]).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def archive_member(info: tarfile.TarInfo) -> tarfile.TarInfo:
+        # Blobs are 0600 and owned by the API user on disk; inside the lab every user
+        # must be able to read them, so members are root-owned and world-readable
+        info.mode = 0o755 if info.isdir() else 0o644
+        info.uid = info.gid = 0
+        info.uname = info.gname = 'root'
+        return info
+
+    def build_archive(self, key: str, files: List[Dict[str, Any]]) -> Path:
+        target = self.archive_dir / f"{key}.tar"
+        try:
+            os.utime(target)
+            return target
+        except FileNotFoundError:
+            pass
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        prefix = LAB_FILES_DIR.strip('/')
+        fd, tmp_path = tempfile.mkstemp(dir=self.archive_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as out, tarfile.open(fileobj=out, mode='w') as tar:
+                folder = tarfile.TarInfo(prefix)
+                folder.type = tarfile.DIRTYPE
+                tar.addfile(self.archive_member(folder))
+                for entry in files:
+                    tar.add(
+                        self.source(entry), arcname=f"{prefix}/{entry['filename']}",
+                        recursive=False, filter=self.archive_member
+                    )
+            os.replace(tmp_path, target)
+        except BaseException:
+            self.remove_file(Path(tmp_path))
+            raise
+        return target
+
+    async def archive(self, files: List[Dict[str, Any]]) -> Path:
+        key = self.archive_key(files)
+        # Concurrent starts of the same room share one build
+        build = self.building.get(key)
+        if build is None:
+            build = self.building[key] = asyncio.ensure_future(self.run(self.build_archive, key, files))
+            build.add_done_callback(lambda _: self.building.pop(key, None))
+        return await asyncio.shield(build)
+
+    def remove_stale_archives(self, live: set):
+        cutoff = time.time() - LAB_ARCHIVE_GRACE
+        for path in self.archive_dir.glob('*'):
+            try:
+                # Leftover *.tmp files are builds that never finished
+                if path.name.split('.')[0] not in live or path.suffix != '.tar':
+                    if path.stat().st_mtime < cutoff:
+                        os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def sweep(self, rooms: List[Dict[str, Any]]):
+        # Catalog reload hook; the live set comes from the rooms, not this worker's history
+        live = {self.archive_key(room['uploaded_files']) for room in rooms if room.get('uploaded_files')}
+        if self.sweeping is None or self.sweeping.done():
+            self.sweeping = asyncio.ensure_future(self.run(self.remove_stale_archives, live))
+
+    async def referenced(self, digest: str) -> bool:
+        return await db.rooms.find_one({'uploaded_files.digest': digest}, {'_id': 1}) is not None
+
+    async def collect(self, digests):
+        for digest in set(digests):
+            if await self.referenced(digest):
+                continue
+            blob = self.path(digest)
+            doomed = blob.with_name(f"{digest}.collect-{uuid.uuid4().hex}")
+            if not await self.run(self.move, blob, doomed):
+                continue
+            if await self.referenced(digest):
+                await self.run(self.move, doomed, blob)
+            else:
+                await self.run(self.remove_file, doomed)
+
+lab_files = LabFileStore(UPLOAD_DIR / 'blobs', UPLOAD_DIR / 'archives', LAB_UPLOAD_MAX_BYTES, LAB_UPLOAD_CHUNK_SIZE)
+catalog.reload_hooks.append(lab_files.sweep)
+
+async def put_lab_file_entry(room_id: str, entry: Dict[str, Any]) -> Optional[str]:
+    # Replaces the room's entry with the same filename, or appends one, in a single
+    # conditional update so concurrent uploads and deletes never lose each other's
+    # entries. Returns the digest of the replaced entry, if any.
+    while True:
+        before = await db.rooms.find_one_and_update(
+            {'id': room_id, 'uploaded_files.filename': entry['filename']},
+            {'$set': {'uploaded_files.$': entry}},
+            projection={'_id': 0, 'uploaded_files': {'$elemMatch': {'filename': entry['filename']}}}
+        )
+        if before is not None:
+            return before['uploaded_files'][0].get('digest')
+        result = await db.rooms.update_one(
+            {'id': room_id, 'uploaded_files.filename': {'$ne': entry['filename']}},
+            {'$push': {'uploaded_files': entry}}
+        )
+        if result.matched_count:
+            return None
+        # Either another upload added this filename in between (retry as a replace)
+        # or the room is gone
+        if not await db.rooms.count_documents({'id': room_id}, limit=1):
+            raise HTTPException(status_code=404, detail="Room not found")
+
 @api_router.post("/admin/upload-lab-files")
 async def upload_lab_files(
     room_id: str,
@@ -570,35 +2854,33 @@ async def upload_lab_files(
     if current_user['role'] != 'admin':
         raise HTTPException(status_code=403, detail="Admin only")
     
-    # Create room-specific directory
-    room_dir = UPLOAD_DIR / room_id
-    room_dir.mkdir(exist_ok=True)
-    
-    uploaded_files = []
-    
-    for file in files:
-        try:
-            # Save file
-            file_path = room_dir / file.filename
-            with open(file_path, 'wb') as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            
-            uploaded_files.append({
-                'filename': file.filename,
-                'path': str(file_path),
-                'size': os.path.getsize(file_path)
-            })
-            
-            logger.info(f"Uploaded file: {file.filename} for room {room_id}")
-        except Exception as e:
-            logger.error(f"Error uploading file {file.filename}: {e}")
-            raise HTTPException(status_code=500, detail=f"Failed to upload {file.filename}")
+    if not await db.rooms.count_documents({'id': room_id}, limit=1):
+        raise HTTPException(status_code=404, detail="Room not found")
     
-    # Update room with uploaded files info
-    await db.rooms.update_one(
-        {'id': room_id},
-        {'$set': {'uploaded_files': uploaded_files}}
-    )
+    staged = []
+    replaced = []
+    try:
+        for file in files:
+            try:
+                staged.append(await lab_files.stage(file))
+                logger.info(f"Uploaded file: {file.filename} for room {room_id}")
+            except HTTPException:
+                raise
+            except Exception as e:
+                logger.error(f"Error uploading file {file.filename}: {e}")
+                raise HTTPException(status_code=500, detail=f"Failed to upload {file.filename}")
+        uploaded_files = [entry for entry, _ in staged]
+        
+        # Merge by filename: re-uploading a name replaces that entry, other files stay
+        for entry, tmp_path in staged:
+            replaced.append(await put_lab_file_entry(room_id, entry))
+            await lab_files.run(lab_files.commit_blob, tmp_path, entry['digest'])
+    finally:
+        # Committed temp files are already gone; this only clears aborted uploads
+        for _, tmp_path in staged:
+            await lab_files.run(lab_files.remove_file, Path(tmp_path))
+    catalog.invalidate()
+    await lab_files.collect(digest for digest in replaced if digest)
     
     return {
         'message': f'Successfully uploaded {len(uploaded_files)} file(s)',
@@ -621,40 +2903,101 @@ async def delete_lab_file(room_id: str, filename: str, current_user: dict = Depe
     if current_user['role'] != 'admin':
         raise HTTPException(status_code=403, detail="Admin only")
     
-    file_path = UPLOAD_DIR / room_id / filename
-    
-    if file_path.exists():
-        os.remove(file_path)
-        
-        # Update room's uploaded files list
-        room = await db.rooms.find_one({'id': room_id}, {'_id': 0})
-        if room and 'uploaded_files' in room:
-            updated_files = [f for f in room['uploaded_files'] if f['filename'] != filename]
-            await db.rooms.update_one(
-                {'id': room_id},
-                {'$set': {'uploaded_files': updated_files}}
-            )
-        
-        return {'message': f'File {filename} deleted'}
-    else:
+    room = await db.rooms.find_one({'id': room_id}, {'_id': 0, 'uploaded_files': 1})
+    entry = next((f for f in (room or {}).get('uploaded_files', []) if f['filename'] == filename), None)
+    if entry is None:
         raise HTTPException(status_code=404, detail="File not found")
+    
+    await db.rooms.update_one(
+        {'id': room_id},
+        {'$pull': {'uploaded_files': {'filename': filename}}}
+    )
+    catalog.invalidate()
+    if entry.get('digest'):
+        await lab_files.collect([entry['digest']])
+    elif entry.get('path'):
+        # Uploads from before the blob store live at uploads/<room_id>/<filename>
+        await lab_files.run(lab_files.remove_file, Path(entry['path']))
+    
+    return {'message': f'File {filename} deleted'}
+
+@api_router.get("/admin/index-check")
+async def check_indexes(current_user: dict = Depends(get_current_user)):
+    if current_user['role'] != 'admin':
+        raise HTTPException(status_code=403, detail="Admin only")
+    report = await verify_query_plans()
+    return {'ok': not any(r['collscan'] for r in report), 'queries': report}
+
+@api_router.get("/admin/metrics")
+async def get_admin_metrics(current_user: dict = Depends(get_current_user)):
+    if current_user['role'] != 'admin':
+        raise HTTPException(status_code=403, detail="Admin only")
+    return {
+        'submission_buffer': submission_buffer.stats(),
+        'code_cache': code_cache.stats(),
+        'code_jobs': code_jobs.stats(),
+        'lab_queue': lab_orchestrator.status(),
+        'rate_limits': rate_limiter.stats()
+    }
+
+class PlatformStats:
+    # Totals behind /admin/stats. Every write path that creates or deletes a user,
+    # room or lab session adjusts them, and they are reconciled against collection
+    # metadata periodically, so they may trail by one interval for writes made by
+    # other workers. active_sessions is counted on each request instead: it must be
+    # exact, and the (status, expires_at) index makes that count cheap.
+    def __init__(self):
+        self.counts = {'total_users': 0, 'total_rooms': 0, 'total_sessions': 0}
+        self.loaded = False
+        self.lock = asyncio.Lock()
+        # Adjustments made while a reconcile is reading, applied on top of its result
+        self.pending: Optional[Dict[str, int]] = None
+
+    def adjust(self, key: str, delta: int):
+        self.counts[key] += delta
+        if self.pending is not None:
+            self.pending[key] += delta
+
+    async def reconcile(self):
+        async with self.lock:
+            self.pending = dict.fromkeys(self.counts, 0)
+            try:
+                users, rooms, sessions = await asyncio.gather(
+                    db.users.estimated_document_count(),
+                    db.rooms.estimated_document_count(),
+                    db.lab_sessions.estimated_document_count()
+                )
+                self.counts = {
+                    'total_users': users + self.pending['total_users'],
+                    'total_rooms': rooms + self.pending['total_rooms'],
+                    'total_sessions': sessions + self.pending['total_sessions']
+                }
+                self.loaded = True
+            finally:
+                self.pending = None
+
+    async def snapshot(self) -> Dict[str, int]:
+        if not self.loaded:
+            await self.reconcile()
+        active = await db.lab_sessions.count_documents({'status': 'running'})
+        return {**self.counts, 'active_sessions': active}
+
+platform_stats = PlatformStats()
+
+async def run_platform_stats_reconcile():
+    while True:
+        await asyncio.sleep(PLATFORM_STATS_RECONCILE_INTERVAL)
+        try:
+            await platform_stats.reconcile()
+        except Exception as e:
+            logger.error(f"Platform stats reconcile failed: {e}")
 
 @api_router.get("/admin/stats")
 async def get_admin_stats(current_user: dict = Depends(get_current_user)):
     if current_user['role'] != 'admin':
         raise HTTPException(status_code=403, detail="Admin only")
     
-    total_users = await db.users.count_documents({})
-    total_rooms = await db.rooms.count_documents({})
-    total_sessions = await db.lab_sessions.count_documents({})
-    active_sessions = await db.lab_sessions.count_documents({'status': 'running'})
-    
-    return {
-        'total_users': total_users,
-        'total_rooms': total_rooms,
-        'total_sessions': total_sessions,
-        'active_sessions': active_sessions
-    }
+    return await platform_stats.snapshot()
 
 @api_router.post("/questions/ask")
 async def ask_question(room_id: str, question_data: Dict[str, str], current_user: dict = Depends(get_current_user)):
@@ -671,43 +3014,147 @@ async def ask_question(room_id: str, question_data: Dict[str, str], current_user
     
     return {k: v for k, v in question_dict.items() if k != '_id'}
 
-@api_router.post("/flags/submit")
-async def submit_flag(request: SubmitFlagRequest, current_user: dict = Depends(get_current_user)):
-    room = await db.rooms.find_one({'id': request.room_id}, {'_id': 0})
-    if not room:
-        raise HTTPException(status_code=404, detail="Room not found")
-    
-    submitted_flag = request.flag
-    is_correct = submitted_flag in room.get('flags', [])
-    
-    if is_correct:
-        progress = await db.user_progress.find_one(
-            {'user_id': current_user['id'], 'room_id': request.room_id},
-            {'_id': 0}
-        )
-        
-        if not progress:
-            progress = UserProgress(
-                user_id=current_user['id'],
-                room_id=request.room_id,
-                completed=True
-            )
-            progress_dict = progress.model_dump()
-            progress_dict['started_at'] = progress.started_at.isoformat()
-            progress_dict['completed_at'] = datetime.now(timezone.utc).isoformat()
-            await db.user_progress.insert_one(progress_dict)
-            
-            new_xp = current_user['xp'] + room.get('xp_reward', 100)
-            await db.users.update_one(
-                {'id': current_user['id']},
-                {'$set': {'xp': new_xp}, '$push': {'completed_rooms': request.room_id}}
-            )
-            
-            return {'correct': True, 'message': 'Flag correct! Room completed!', 'xp_earned': room.get('xp_reward', 100)}
-        else:
-            return {'correct': True, 'message': 'Flag correct! Already completed.'}
-    
-    return {'correct': False, 'message': 'Incorrect flag. Try again!'}
+class RoomAnswerCache:
+    # Per-room map of flag_id -> (normalized answer, points, room_id), loaded with one
+    # indexed query per room and dropped when an admin adds or deletes a question.
+    # ROOM_ANSWER_CACHE_TTL bounds staleness for edits made in other workers.
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.rooms: Dict[str, tuple] = {}
+        self.flag_rooms: Dict[str, str] = {}
+
+    async def room(self, room_id: str) -> Dict[str, Dict[str, Any]]:
+        cached = self.rooms.get(room_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        flags = await db.room_flags.find(
+            {'room_id': room_id},
+            {'_id': 0, 'id': 1, 'room_id': 1, 'correct_answer': 1, 'points': 1}
+        ).to_list(None)
+        answers = {
+            f['id']: {'answer': f['correct_answer'].strip().lower(), 'points': f.get('points', 10), 'room_id': room_id}
+            for f in flags
+        }
+        self.rooms[room_id] = (time.monotonic() + self.ttl, answers)
+        for flag_id in answers:
+            self.flag_rooms[flag_id] = room_id
+        return answers
+
+    async def flag(self, flag_id: str) -> Optional[Dict[str, Any]]:
+        room_id = self.flag_rooms.get(flag_id)
+        if room_id is None:
+            flag = await db.room_flags.find_one({'id': flag_id}, {'_id': 0, 'room_id': 1})
+            if not flag:
+                return None
+            room_id = flag['room_id']
+        return (await self.room(room_id)).get(flag_id)
+
+    def invalidate(self, room_id: str):
+        self.rooms.pop(room_id, None)
+
+room_answers = RoomAnswerCache(ROOM_ANSWER_CACHE_TTL)
+
+class WriteBehindBuffer:
+    # Batches audit-only inserts into insert_many calls every flush_ms or once
+    # batch_size records are waiting, and drains completely on shutdown. Memory is
+    # capped at max_size records; past that the overflow policy either writes the
+    # record straight through, drops the oldest queued record, or drops the new one.
+    def __init__(self, collection: str, flush_ms: int, batch_size: int, max_size: int, overflow: str):
+        self.collection = collection
+        self.flush_interval = flush_ms / 1000
+        self.batch_size = batch_size
+        self.max_size = max_size
+        self.overflow = overflow
+        self.queue: deque = deque()
+        self.metrics = {
+            'enqueued': 0, 'flushed': 0, 'dropped': 0, 'written_through': 0,
+            'failed_batches': 0, 'max_depth': 0, 'last_flush_ms': 0.0
+        }
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        self._task: Optional[asyncio.Task] = None
+
+    async def add(self, doc: Dict[str, Any]):
+        if len(self.queue) >= self.max_size:
+            if self.overflow == 'drop_newest':
+                self.metrics['dropped'] += 1
+                return
+            if self.overflow == 'drop_oldest':
+                self.queue.popleft()
+                self.metrics['dropped'] += 1
+            else:
+                self.metrics['written_through'] += 1
+                await db[self.collection].insert_one(doc)
+                return
+        self.queue.append(doc)
+        self.metrics['enqueued'] += 1
+        self.metrics['max_depth'] = max(self.metrics['max_depth'], len(self.queue))
+        if len(self.queue) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self) -> bool:
+        batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+        if not batch:
+            return False
+        started = time.monotonic()
+        try:
+            await db[self.collection].insert_many(batch, ordered=False)
+            self.metrics['flushed'] += len(batch)
+        except BulkWriteError as e:
+            # Partially applied; the rejected records would fail again, so they are dropped
+            inserted = e.details.get('nInserted', 0)
+            self.metrics['flushed'] += inserted
+            self.metrics['dropped'] += len(batch) - inserted
+            self.metrics['failed_batches'] += 1
+            logger.error(f"Write-behind flush to {self.collection} rejected {len(batch) - inserted} record(s)")
+        except asyncio.CancelledError:
+            # insert_many has already stamped each record's _id, so any the server did
+            # write are rejected as duplicates on the retry rather than stored twice
+            self.queue.extendleft(reversed(batch))
+            raise
+        except Exception as e:
+            self.metrics['failed_batches'] += 1
+            logger.error(f"Write-behind flush to {self.collection} failed ({len(batch)} records): {e}")
+            # Put the batch back for the next attempt, as far as the size cap allows
+            room = max(self.max_size - len(self.queue), 0)
+            self.queue.extendleft(reversed(batch[:room]))
+            self.metrics['dropped'] += len(batch) - min(room, len(batch))
+            return False
+        finally:
+            self.metrics['last_flush_ms'] = round((time.monotonic() - started) * 1000, 1)
+        return True
+
+    async def run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            while not self._closing and await self.flush() and len(self.queue) >= self.batch_size:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def close(self):
+        # Let an in-flight flush finish instead of cancelling it mid-insert
+        self._closing = True
+        self._wakeup.set()
+        if self._task:
+            await self._task
+            self._task = None
+        while self.queue and await self.flush():
+            pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {'depth': len(self.queue), 'max_size': self.max_size, 'overflow': self.overflow, **self.metrics}
+
+submission_buffer = WriteBehindBuffer(
+    'flag_submissions', SUBMISSION_BUFFER_FLUSH_MS, SUBMISSION_BUFFER_BATCH_SIZE,
+    SUBMISSION_BUFFER_MAX_SIZE, SUBMISSION_BUFFER_OVERFLOW
+)
 
 @api_router.post("/admin/room-flags/add")
 async def add_room_flag(room_id: str, flag_data: Dict[str, Any], current_user: dict = Depends(get_current_user)):
@@ -725,6 +3172,7 @@ async def add_room_flag(room_id: str, flag_data: Dict[str, Any], current_user: d
     flag_dict = flag.model_dump()
     flag_dict['created_at'] = flag.created_at.isoformat()
     await db.room_flags.insert_one(flag_dict)
+    room_answers.invalidate(room_id)
     
     return {k: v for k, v in flag_dict.items() if k != '_id'}
 
@@ -749,12 +3197,13 @@ async def get_admin_room_flags(room_id: str, current_user: dict = Depends(get_cu
 
 @api_router.post("/room-flags/check")
 async def check_flag_answer(flag_id: str, answer_data: Dict[str, str], current_user: dict = Depends(get_current_user)):
-    flag = await db.room_flags.find_one({'id': flag_id}, {'_id': 0})
+    await rate_limiter.check('room_flags_check', current_user['id'], flag=flag_id)
+    flag = await room_answers.flag(flag_id)
     if not flag:
         raise HTTPException(status_code=404, detail="Question not found")
     
     submitted_answer = answer_data.get('answer', '').strip()
-    is_correct = submitted_answer.lower() == flag['correct_answer'].lower()
+    is_correct = submitted_answer.lower() == flag['answer']
     
     submission = FlagSubmissionModel(
         room_id=flag['room_id'],
@@ -767,36 +3216,88 @@ async def check_flag_answer(flag_id: str, answer_data: Dict[str, str], current_u
     submission_dict = submission.model_dump()
     submission_dict['submitted_at'] = submission.submitted_at.isoformat()
     
-    existing = await db.flag_submissions.find_one({
-        'flag_id': flag_id,
-        'user_id': current_user['id'],
-        'is_correct': True
-    }, {'_id': 0})
-    
-    if not existing:
-        await db.flag_submissions.insert_one(submission_dict)
-        
-        if is_correct:
-            new_xp = current_user['xp'] + flag.get('points', 10)
-            await db.users.update_one(
-                {'id': current_user['id']},
-                {'$inc': {'xp': flag.get('points', 10)}}
-            )
-            return {'correct': True, 'message': 'Correct answer!', 'points_earned': flag.get('points', 10)}
-    else:
-        if is_correct:
-            return {'correct': True, 'message': 'Already answered correctly!', 'points_earned': 0}
+    if is_correct:
+        # The partial unique index on correct (flag_id, user_id) submissions makes the insert the claim
+        points = flag.get('points', 10)
+        if await award_xp_once(partial(db.flag_submissions.insert_one, submission_dict), current_user['id'], points):
+            return {'correct': True, 'message': 'Correct answer!', 'points_earned': points}
+        return {'correct': True, 'message': 'Already answered correctly!', 'points_earned': 0}
     
+    # Wrong answers are pure audit data and go through the write-behind buffer
+    await submission_buffer.add(submission_dict)
     return {'correct': False, 'message': 'Incorrect answer. Try again!'}
 
+@api_router.post("/room-flags/check-batch")
+async def check_flag_answers(request: BatchAnswerRequest, current_user: dict = Depends(get_current_user)):
+    await rate_limiter.check('room_flags_check_batch', current_user['id'], room=request.room_id)
+    answers = await room_answers.room(request.room_id)
+    
+    results = []
+    submissions = []
+    for flag_id, answer in request.answers.items():
+        flag = answers.get(flag_id)
+        if not flag:
+            results.append({'flag_id': flag_id, 'correct': False, 'points_earned': 0, 'error': 'Question not found'})
+            continue
+        submitted_answer = answer.strip()
+        is_correct = submitted_answer.lower() == flag['answer']
+        submission = FlagSubmissionModel(
+            room_id=request.room_id,
+            flag_id=flag_id,
+            user_id=current_user['id'],
+            submitted_answer=submitted_answer,
+            is_correct=is_correct
+        )
+        submission_dict = submission.model_dump()
+        submission_dict['submitted_at'] = submission.submitted_at.isoformat()
+        submissions.append(submission_dict)
+        results.append({'flag_id': flag_id, 'correct': is_correct, 'points_earned': 0, '_submission': len(submissions) - 1})
+    
+    # One unordered insert for every submission; correct answers that were already
+    # recorded bounce off the partial unique index and earn nothing
+    if any(submission['is_correct'] for submission in submissions):
+        require_xp_awards()
+    duplicates = set()
+    if submissions:
+        try:
+            await db.flag_submissions.insert_many(submissions, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            if any(error['code'] != 11000 for error in errors):
+                raise
+            duplicates = {error['index'] for error in errors}
+    
+    total_points = 0
+    for result in results:
+        index = result.pop('_submission', None)
+        if index is None or not result['correct']:
+            continue
+        if index in duplicates:
+            result['already_answered'] = True
+        else:
+            result['points_earned'] = answers[result['flag_id']]['points']
+            total_points += result['points_earned']
+    
+    if total_points:
+        await db.users.update_one({'id': current_user['id']}, {'$inc': {'xp': total_points}})
+        record_xp_award(current_user['id'], total_points)
+    
+    return {
+        'room_id': request.room_id,
+        'results': results,
+        'correct_count': sum(1 for r in results if r['correct']),
+        'points_earned': total_points
+    }
+
 @api_router.delete("/admin/room-flags/{flag_id}")
 async def delete_room_flag(flag_id: str, current_user: dict = Depends(get_current_user)):
     if current_user['role'] != 'admin':
         raise HTTPException(status_code=403, detail="Admin only")
     
-    result = await db.room_flags.delete_one({'id': flag_id})
-    if result.deleted_count == 0:
+    flag = await db.room_flags.find_one_and_delete({'id': flag_id}, {'_id': 0, 'room_id': 1})
+    if not flag:
         raise HTTPException(status_code=404, detail="Question not found")
+    room_answers.invalidate(flag['room_id'])
     
     return {'message': 'Question deleted'}
 
@@ -843,6 +3344,7 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],
 )
 
 logging.basicConfig(
@@ -850,8 +3352,188 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 
+# Every index the API relies on. Created at startup; unique where the code
+# assumes at most one document per key. 'dedupe' marks unique indexes whose
+# collections may hold duplicates written before the index existed: all but the
+# first document of each key, in that sort order, are deleted before creating it.
+INDEXES = [
+    {'collection': 'users', 'keys': [('id', 1)], 'unique': True},
+    {'collection': 'users', 'keys': [('email', 1)], 'unique': True},
+    {'collection': 'users', 'keys': [('xp', -1), ('id', 1)]},
+    {'collection': 'users', 'keys': [('role', 1), ('id', 1)]},
+    {'collection': 'user_progress', 'keys': [('user_id', 1), ('room_id', 1)], 'unique': True,
+     'dedupe': {'completed': -1, '_id': 1}},
+    {'collection': 'user_progress', 'keys': [('user_id', 1), ('completed', 1)]},
+    {'collection': 'flag_submissions', 'keys': [('flag_id', 1), ('user_id', 1), ('is_correct', 1)]},
+    {'collection': 'flag_submissions', 'keys': [('user_id', 1), ('is_correct', 1)]},
+    {'collection': 'flag_submissions', 'keys': [('flag_id', 1), ('user_id', 1)], 'unique': True,
+     'partialFilterExpression': {'is_correct': True}, 'dedupe': {'_id': 1}},
+    {'collection': 'lab_sessions', 'keys': [('id', 1)], 'unique': True},
+    {'collection': 'lab_sessions', 'keys': [('user_id', 1), ('room_id', 1), ('status', 1)]},
+    {'collection': 'lab_sessions', 'keys': [('status', 1), ('expires_at', 1)]},
+    {'collection': 'room_flags', 'keys': [('id', 1)], 'unique': True},
+    {'collection': 'room_flags', 'keys': [('room_id', 1), ('order', 1)]},
+    {'collection': 'questions', 'keys': [('id', 1)], 'unique': True},
+    {'collection': 'questions', 'keys': [('room_id', 1), ('created_at', -1)]},
+    {'collection': 'rooms', 'keys': [('id', 1)], 'unique': True},
+    {'collection': 'rooms', 'keys': [('roadmap_id', 1)]},
+    {'collection': 'rooms', 'keys': [('uploaded_files.digest', 1)], 'sparse': True},
+    {'collection': 'roadmaps', 'keys': [('order', 1)]},
+    {'collection': 'xp_windows', 'keys': [('window', 1), ('bucket', 1), ('user_id', 1)], 'unique': True},
+    {'collection': 'xp_windows', 'keys': [('window', 1), ('bucket', 1), ('xp', -1), ('user_id', 1)]},
+    {'collection': 'xp_windows', 'keys': [('expires_at', 1)], 'expireAfterSeconds': 0},
+    {'collection': 'xp_windows', 'keys': [('user_id', 1)]},
+    {'collection': 'rate_limits', 'keys': [('expires_at', 1)], 'expireAfterSeconds': 0},
+    {'collection': 'code_jobs', 'keys': [('expires_at', 1)], 'expireAfterSeconds': 0},
+    {'collection': 'lab_instances', 'keys': [('seen_at', 1)], 'expireAfterSeconds': 86400},
+    {'collection': 'coding_challenges', 'keys': [('id', 1)], 'unique': True},
+]
+
+# Representative filter/sort shapes of the hot queries, verified with explain()
+QUERY_SHAPES = [
+    {'collection': 'users', 'filter': {'id': 'x'}},
+    {'collection': 'users', 'filter': {'email': 'x'}},
+    {'collection': 'users', 'filter': {}, 'sort': {'xp': -1}, 'limit': 10},
+    {'collection': 'users', 'filter': {'role': 'x', 'id': {'$gt': 'x'}}, 'sort': {'id': 1}, 'limit': 100},
+    {'collection': 'user_progress', 'filter': {'user_id': 'x', 'room_id': 'x'}},
+    {'collection': 'user_progress', 'filter': {'user_id': 'x', 'completed': True}},
+    {'collection': 'flag_submissions', 'filter': {'flag_id': 'x', 'user_id': 'x', 'is_correct': True}},
+    {'collection': 'flag_submissions', 'filter': {'user_id': 'x', 'is_correct': True}},
+    {'collection': 'lab_sessions', 'filter': {'user_id': 'x', 'room_id': 'x', 'status': 'running'}},
+    {'collection': 'lab_sessions', 'filter': {'id': 'x', 'user_id': 'x'}},
+    {'collection': 'lab_sessions', 'filter': {'status': 'running', 'expires_at': {'$lte': 'x'}}},
+    {'collection': 'lab_sessions', 'filter': {'status': 'running'}},
+    {'collection': 'room_flags', 'filter': {'room_id': 'x'}, 'sort': {'order': 1}},
+    {'collection': 'room_flags', 'filter': {'id': 'x'}},
+    {'collection': 'questions', 'filter': {'room_id': 'x'}, 'sort': {'created_at': -1}},
+    {'collection': 'rooms', 'filter': {'id': 'x'}},
+    {'collection': 'rooms', 'filter': {'uploaded_files.digest': 'x'}},
+    {'collection': 'xp_windows', 'filter': {'window': 'x', 'bucket': 'x'}, 'sort': {'xp': -1, 'user_id': 1}, 'limit': 10},
+    {'collection': 'xp_windows', 'filter': {'user_id': 'x'}},
+]
+
+def index_name(keys) -> str:
+    return '_'.join(f"{field}_{direction}" for field, direction in keys)
+
+async def remove_duplicates(spec: Dict[str, Any]) -> int:
+    collection = db[spec['collection']]
+    key = {field: f"${field}" for field, _ in spec['keys']}
+    pipeline = [
+        {'$match': spec.get('partialFilterExpression', {})},
+        {'$sort': spec['dedupe']},
+        {'$group': {'_id': key, 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}}
+    ]
+    removed = 0
+    async for group in collection.aggregate(pipeline, allowDiskUse=True):
+        result = await collection.delete_many({'_id': {'$in': group['ids'][1:]}})
+        removed += result.deleted_count
+    return removed
+
+async def ensure_indexes() -> List[str]:
+    # Returns the names of indexes that could not be created
+    failed = []
+    for spec in INDEXES:
+        name = index_name(spec['keys'])
+        options = {k: v for k, v in spec.items() if k not in ('collection', 'keys', 'dedupe')}
+        try:
+            if spec.get('dedupe'):
+                existing = await db[spec['collection']].index_information()
+                if name not in existing:
+                    removed = await remove_duplicates(spec)
+                    if removed:
+                        logger.warning(f"Removed {removed} duplicate document(s) from {spec['collection']} before indexing {name}")
+            await db[spec['collection']].create_index(spec['keys'], name=name, **options)
+        except Exception as e:
+            logger.error(f"Failed to create index {spec['collection']}.{name}: {e}")
+            failed.append(f"{spec['collection']}.{name}")
+    return failed
+
+def plan_stages(plan: Dict[str, Any]):
+    yield plan.get('stage')
+    for key in ('inputStage', 'queryPlan'):
+        if isinstance(plan.get(key), dict):
+            yield from plan_stages(plan[key])
+    for child in plan.get('inputStages', []):
+        yield from plan_stages(child)
+
+async def verify_query_plans() -> List[Dict[str, Any]]:
+    report = []
+    for shape in QUERY_SHAPES:
+        command = {'find': shape['collection'], 'filter': shape['filter']}
+        for option in ('sort', 'limit'):
+            if option in shape:
+                command[option] = shape[option]
+        explain = await db.command({'explain': command, 'verbosity': 'queryPlanner'})
+        stages = list(plan_stages(explain['queryPlanner']['winningPlan']))
+        report.append({
+            'collection': shape['collection'],
+            'filter': shape['filter'],
+            'sort': shape.get('sort'),
+            'stages': [stage for stage in stages if stage],
+            'collscan': 'COLLSCAN' in stages
+        })
+    return report
+
+lab_reaper_task: Optional[asyncio.Task] = None
+leaderboard_task: Optional[asyncio.Task] = None
+platform_stats_task: Optional[asyncio.Task] = None
+
+@app.on_event("startup")
+async def bootstrap_indexes():
+    global xp_awards_enabled
+    await ensure_indexes()
+    xp_awards_enabled = await verify_claim_indexes()
+    if INDEX_CHECK_MODE == 'off':
+        return
+    scans = [r for r in await verify_query_plans() if r['collscan']]
+    for r in scans:
+        logger.warning(f"COLLSCAN: {r['collection']} filter={r['filter']} sort={r['sort']}")
+    if scans and INDEX_CHECK_MODE == 'strict':
+        raise RuntimeError(f"{len(scans)} query shape(s) fall back to a collection scan")
+
+@app.on_event("startup")
+async def start_background_services():
+    global lab_reaper_task, leaderboard_task, platform_stats_task
+    if CODE_EXEC_BACKEND == 'local':
+        code_sandbox.check()
+    elif CODE_EXEC_BACKEND == 'docker':
+        await code_sandbox.prepare()
+    await heartbeat_lab_instance()
+    # Loading the catalog also sweeps lab archives left over from earlier runs
+    await catalog.ensure()
+    if docker_client:
+        try:
+            await reconcile_lab_containers()
+        except Exception as e:
+            logger.error(f"Lab reconcile failed: {e}")
+        images = await db.rooms.distinct('docker_image', {'has_lab': True})
+        for image in images:
+            if image:
+                lab_pool.register_image(image)
+        lab_pool.start()
+    lab_reaper_task = asyncio.create_task(run_lab_reaper())
+    code_jobs.start()
+    submission_buffer.start()
+    await rebuild_leaderboard()
+    leaderboard_task = asyncio.create_task(run_leaderboard_rebuilds())
+    await platform_stats.reconcile()
+    platform_stats_task = asyncio.create_task(run_platform_stats_reconcile())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in (lab_reaper_task, leaderboard_task, platform_stats_task):
+        if task:
+            task.cancel()
+    code_jobs.stop()
+    await submission_buffer.close()
+    if docker_client:
+        await lab_pool.drain()
+        lab_orchestrator.shutdown()
+    password_executor.shutdown(wait=False, cancel_futures=True)
+    if CODE_EXEC_BACKEND == 'docker':
+        code_sandbox.executor.shutdown(wait=False, cancel_futures=True)
+    lab_files.executor.shutdown(wait=False, cancel_futures=True)
     client.close()
     if docker_client:
         docker_client.close()
@@ -25,7 +25,8 @@ const WebLabPage = () => {
       // For demo, use first web room
       const webRoom = rooms.data.find(r => r.lab_type === 'web');
       if (webRoom) {
-        setRoom(webRoom);
+        const details = await roomAPI.getById(webRoom.id);
+        setRoom(details.data);
         setWebAppUrl(webRoom.web_app_url || 'about:blank');
       }
     } catch (error) {
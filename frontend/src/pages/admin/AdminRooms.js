@@ -180,7 +180,16 @@ const AdminRooms = () => {
     }
   };
 
-  const handleEdit = (room) => {
+  const handleEdit = async (summary) => {
+    let room = summary;
+    try {
+      // Listings only carry room summaries; load content and tasks for editing
+      const response = await roomAPI.getById(summary.id);
+      room = response.data;
+    } catch (error) {
+      toast.error('Failed to load room details');
+      return;
+    }
     setEditingRoom(room);
     setRoomType(room.room_type || 'cybersecurity');
     setCurrentRoomId(room.id);
@@ -8,15 +8,17 @@ import { toast } from 'sonner';
 const AdminUsers = () => {
   const [users, setUsers] = useState([]);
   const [loading, setLoading] = useState(true);
+  const [nextCursor, setNextCursor] = useState(null);
 
   useEffect(() => {
     fetchUsers();
   }, []);
 
-  const fetchUsers = async () => {
+  const fetchUsers = async (cursor = null) => {
     try {
-      const response = await adminAPI.getUsers();
-      setUsers(response.data);
+      const response = await adminAPI.getUsers(cursor ? { cursor } : undefined);
+      setUsers(cursor ? [...users, ...response.data] : response.data);
+      setNextCursor(response.headers['x-next-cursor'] || null);
     } catch (error) {
       toast.error('Failed to load users');
     } finally {
@@ -120,6 +122,19 @@ const AdminUsers = () => {
             ))}
           </div>
         </div>
+
+        {nextCursor && (
+          <div className="mt-4 text-center">
+            <Button
+              onClick={() => fetchUsers(nextCursor)}
+              variant="outline"
+              className="border-white/20 text-textMain font-mono"
+              data-testid="load-more-users"
+            >
+              Load more
+            </Button>
+          </div>
+        )}
       </div>
     </div>
   );
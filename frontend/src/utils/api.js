@@ -58,7 +58,7 @@ export const userAPI = {
 };
 
 export const adminAPI = {
-  getUsers: () => api.get('/admin/users'),
+  getUsers: (params) => api.get('/admin/users', { params }),
   updateRole: (userId, role) => api.put(`/admin/users/${userId}/role`, { role }),
   deleteUser: (userId) => api.delete(`/admin/users/${userId}`),
   getStats: () => api.get('/admin/stats'),